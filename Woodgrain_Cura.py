@@ -1,7 +1,16 @@
 import re 
 import random
+import cProfile
 import math
 import datetime
+import hashlib
+import json
+import os
+import sys
+import tempfile
+import multiprocessing
+import numpy as np
+from collections import namedtuple, deque, OrderedDict
 
 # ----------------------------
 # Global settings (user controls)
@@ -14,16 +23,18 @@ GRAIN_SIZE_DEFAULT = 2.0
 SPIKINESS_POWER_DEFAULT = 1.0
 SEED_DEFAULT = 42
 SCAN_FOR_ZHOP_DEFAULT = 5
+WORKERS_DEFAULT = 1
 
 
 # -- Required for the Cura wrapper --
 from ..Script import Script
 
-from time import sleep
+from time import monotonic, perf_counter, process_time
 import threading
 
 from UM.Logger import Logger
 from UM.Message import Message
+from UM.Resources import Resources
 from PyQt6.QtCore import QCoreApplication
 from UM.Qt.QtApplication import QtApplication
 
@@ -34,6 +45,171 @@ except NameError:
     xrange = range
 
 
+# A gcode word is an upper case letter followed by an (unsigned) number, e.g. "G1", "Z0.2" or "F.5"
+GCODE_WORD = re.compile(r'([A-Z])([0-9]+\.?[0-9]*|\.[0-9]+)?')
+GcodeLine = namedtuple('GcodeLine', ['command', 'words', 'comment'])
+
+
+def parse_line(line):
+    # Tokenize the line once: its command (e.g. "G1"), its words as {letter: value} and the offset of
+    # its comment (-1 if none). Comments and blank lines do not cost any regex call, others cost one.
+    comment = line.find(';')
+    code = line if comment < 0 else line[:comment]
+    words = {}
+    command = None
+    if code and not code.isspace():
+        for key, value in GCODE_WORD.findall(code):
+            if key not in words:  # only the first occurrence counts
+                words[key] = float(value) if value else None
+                if command is None:
+                    command = key + value
+    return GcodeLine(command, words, comment)
+
+
+class ProfileCache:
+    # Normalized Z profiles (the noise at each Z), kept in memory and on disk, keyed by a hash of the settings
+    # that shape them and of the Z set. Profiles only depend on these, so repeated runs skip the noise stage.
+    # The disk cache is trimmed to max_bytes, least recently used first.
+
+    VERSION = 1  # bump whenever the noise computation changes
+    MEMORY_ENTRIES = 16
+    memory = OrderedDict()  # shared by the whole process, i.e. kept between two slices in Cura
+
+    def __init__(self, directory, max_bytes=32 * 1024 * 1024):
+        self.directory = directory
+        self.max_bytes = max_bytes
+
+    @classmethod
+    def key(cls, settings, zs):
+        return hashlib.sha1(repr((cls.VERSION, settings, zs)).encode("utf-8")).hexdigest()
+
+    def get(self, key, zs):
+        values = self.memory.get(key)
+        if values is not None:
+            self.memory.pop(key)
+        else:
+            path = os.path.join(self.directory, key + ".json")
+            try:
+                with open(path, "r") as f:
+                    values = json.load(f)
+                os.utime(path, None)  # keep it recently used
+            except (IOError, OSError, ValueError):
+                return None
+            if len(values) != len(zs):
+                return None
+        self.remember(key, values)
+        return dict(zip(zs, values))
+
+    def remember(self, key, values):
+        # Most recently used last, the least recently used ones beyond MEMORY_ENTRIES are dropped
+        self.memory[key] = values
+        while len(self.memory) > self.MEMORY_ENTRIES:
+            self.memory.popitem(last=False)
+
+    def put(self, key, zs, noises):
+        values = [noises[z] for z in zs]
+        self.remember(key, values)
+        try:
+            os.makedirs(self.directory, exist_ok=True)
+            fd, tmpname = tempfile.mkstemp(suffix=".tmp", dir=self.directory)
+            with os.fdopen(fd, "w") as f:
+                json.dump(values, f)  # floats are written with repr(), so they are read back exactly
+            os.replace(tmpname, os.path.join(self.directory, key + ".json"))
+            self.evict()
+        except OSError as e:
+            Logger.log("w", "[Woodgrain Effect] Could not cache the temperature profile: " + str(e))
+
+    def evict(self):
+        entries = []
+        total = 0
+        for name in os.listdir(self.directory):
+            if name.endswith(".json"):
+                stat = os.stat(os.path.join(self.directory, name))
+                entries.append((stat.st_mtime, stat.st_size, name))
+                total += stat.st_size
+        entries.sort()
+        for mtime, size, name in entries:
+            if total <= self.max_bytes:
+                break
+            os.remove(os.path.join(self.directory, name))
+            total -= size
+
+
+class ZHopDetector:
+    # Tells, for each move of a stream of (line number, Z), whether a lower Z follows within the `depth` lines
+    # starting at it, i.e. whether it goes up for a z-hop rather than to a new layer. The moves waiting for a
+    # decision stay in a bounded ring buffer, along with a monotonic queue of the candidates for the minimum Z
+    # of their window: any depth costs O(1) amortized per move, and each line is parsed only once.
+
+    def __init__(self, depth):
+        self.depth = depth
+        self.pending = deque()  # (line number, Z) of the moves still waiting for their decision
+        self.minima = deque()  # increasing Z of the pending moves that may still be the lowest of a window
+
+    def feed(self, number, z):
+        # Returns the (line number, Z, is z-hop) decisions this move makes possible, in stream order
+        decisions = []
+        while self.pending and number >= self.pending[0][0] + self.depth:
+            decisions.append(self.decide())
+        self.pending.append((number, z))
+        while self.minima and self.minima[-1][1] >= z:
+            self.minima.pop()
+        self.minima.append((number, z))
+        return decisions
+
+    def decide(self):
+        # All the moves following the oldest pending one are within its window
+        number, z = self.pending.popleft()
+        if self.minima[0][0] == number:
+            self.minima.popleft()
+        return number, z, bool(self.minima) and self.minima[0][1] < z
+
+    def scan(self, moves):
+        for number, z in moves:
+            for decision in self.feed(number, z):
+                yield decision
+        while self.pending:
+            yield self.decide()
+
+
+class Stopwatch:
+    # Wall and CPU time of the successive stages of a run, with the count of what each stage went through
+    # (lines, or Z values for the noise). Each start() ends the former stage, a stage run twice adds up.
+
+    def __init__(self):
+        self.stages = OrderedDict()  # name: [wall seconds, cpu seconds, count]
+        self.current = None
+
+    def start(self, name, count=0):
+        self.stop()
+        self.stages.setdefault(name, [0.0, 0.0, 0])[2] += count
+        self.current = (name, perf_counter(), process_time())
+
+    def count(self, count):
+        self.stages[self.current[0]][2] += count
+
+    def stop(self):
+        if self.current is not None:
+            name, wall, cpu = self.current
+            stage = self.stages[name]
+            stage[0] += perf_counter() - wall
+            stage[1] += process_time() - cpu
+            self.current = None
+
+    def report(self):
+        lines = ["  %-10s %10s %10s %10s %12s" % ("stage", "wall s", "cpu s", "count", "count/s")]
+        for name, (wall, cpu, count) in self.stages.items():
+            rate = "%12.0f" % (count / wall) if count and wall > 0 else "%12s" % "-"
+            lines.append("  %-10s %10.4f %10.4f %10i %s" % (name, wall, cpu, count, rate))
+        lines.append("  %-10s %10.4f %10.4f" % ("total", sum(s[0] for s in self.stages.values()),
+                                                 sum(s[1] for s in self.stages.values())))
+        return "\n".join(lines)
+
+
+class WoodgrainCancelled(Exception):
+    pass
+
+
 class Woodgrain_Cura(Script):
 
     class Perlin:
@@ -124,6 +300,62 @@ class Woodgrain_Cura(Script):
                 frequency *= 2
             return value / total_amplitude
 
+        # Batch versions of the above for whole arrays of coordinates. They chain the very same float
+        # operations in the same order, so that each value is bit for bit the one of the scalar version.
+
+        @staticmethod
+        def grad_batch(hash_code, x, y, z):
+            h = hash_code & 15
+            u = np.where(h < 8, x, y)
+            v = np.where(h < 4, y, np.where((h == 12) | (h == 14), x, z))
+            return np.where((h & 1) == 0, u, -u) + np.where((h & 2) == 0, v, -v)
+
+        def noise_batch(self, x, y, z):
+            perm = np.asarray(self.perm)
+            x, y, z = np.broadcast_arrays(np.asarray(x, dtype=float), np.asarray(y, dtype=float), np.asarray(z, dtype=float))
+
+            xi = np.trunc(x)
+            yi = np.trunc(y)
+            zi = np.trunc(z)
+            X = xi.astype(int) & (self.tile_dimension - 1)
+            Y = yi.astype(int) & (self.tile_dimension - 1)
+            Z = zi.astype(int) & (self.tile_dimension - 1)
+
+            x = x - xi
+            y = y - yi
+            z = z - zi
+
+            u = self.fade(x)
+            v = self.fade(y)
+            w = self.fade(z)
+
+            A = perm[X] + Y
+            AA = perm[A] + Z
+            AB = perm[A + 1] + Z
+            B = perm[X + 1] + Y
+            BA = perm[B] + Z
+            BB = perm[B + 1] + Z
+
+            grad = self.grad_batch
+            return self.lerp(w, self.lerp(v,
+                self.lerp(u, grad(perm[AA], x, y, z), grad(perm[BA], x - 1, y, z)),
+                self.lerp(u, grad(perm[AB], x, y - 1, z), grad(perm[BB], x - 1, y - 1, z))),
+                self.lerp(v,
+                    self.lerp(u, grad(perm[AA + 1], x, y, z - 1), grad(perm[BA + 1], x - 1, y, z - 1)),
+                    self.lerp(u, grad(perm[AB + 1], x, y - 1, z - 1), grad(perm[BB + 1], x - 1, y - 1, z - 1))))
+
+        def fractal_batch(self, octaves, persistence, x, y, z, frequency=1):
+            value = 0.0
+            amplitude = 1.0
+            total_amplitude = 0.0
+            for octave in xrange(octaves):
+                n = self.noise_batch(np.multiply(x, frequency), np.multiply(y, frequency), np.multiply(z, frequency))
+                value += amplitude * n
+                total_amplitude += amplitude
+                amplitude *= persistence
+                frequency *= 2
+            return value / total_amplitude
+
 
     def getSettingDataString(self):
         return """{
@@ -201,12 +433,27 @@ class Woodgrain_Cura(Script):
                 "scanForZHop":
                 {
                     "label": "Scan for z-hop",
-                    "description": "Lines to scan ahead for Z-Hop. Max 5, 0 to disable",
+                    "description": "Lines to scan ahead for Z-Hop, 0 to disable",
                     "type": "int",
                     "value": "%i",
                     "minimum_value": "0",
-                    "maximum_value": "5",
                     "unit": ""
+                },
+                "workers":
+                {
+                    "label": "Worker processes",
+                    "description": "Rewrite the layers in this many processes at once, at most one per CPU, 1 to disable (Linux only, where processes can be forked)",
+                    "type": "int",
+                    "value": "%i",
+                    "minimum_value": "1",
+                    "unit": ""
+                },
+                "profile":
+                {
+                    "label": "Profile",
+                    "description": "Log the time each stage takes to cura.log, and save a cProfile of the run (woodgrain/apply_woodgrain.pstats in the cache folder)",
+                    "type": "bool",
+                    "default_value": false
                 }
             }
         }""" % (
@@ -217,7 +464,8 @@ class Woodgrain_Cura(Script):
             GRAIN_SIZE_DEFAULT,
             SPIKINESS_POWER_DEFAULT,
             SEED_DEFAULT,
-            SCAN_FOR_ZHOP_DEFAULT
+            SCAN_FOR_ZHOP_DEFAULT,
+            WORKERS_DEFAULT
         )
 
 
@@ -226,62 +474,98 @@ class Woodgrain_Cura(Script):
 
         self.progress_bar = Message(title="Applying Woodgrain Effect", text="This may take several minutes, please be patient.\n\n",
                                     lifetime=0, dismissable=False, progress=-1)
+        self.progress_bar.addAction("cancel", "Cancel", "", "Leave the gcode without the woodgrain effect")
+        self.progress_bar.actionTriggered.connect(self.on_progress_action)
         self.progress_bar.show()
 
-        self._locks = {}
-        self._locks["metadata"] = threading.Lock()
-        self._locks["output"] = threading.Lock()
+        # The worker publishes self.progress every few thousand lines (assigning a tuple needs no lock),
+        # sets self._done when it is over, and stops early once self._cancelled is set
+        self._done = threading.Event()
+        self._cancelled = threading.Event()
 
         self.progress = (-1,0)
-        self.output_gcode=[]
+        self.output_gcode = None
 
-        self.apply_woodgrain_thread = threading.Thread(target=self.apply_woodgrain, args=(data,))
+        self.apply_woodgrain_thread = threading.Thread(target=self.run_woodgrain, args=(data,))
         self.apply_woodgrain_thread.start()
 
         GUI_UPDATE_FREQUENCY = 50
-        PROGRESS_CHECK_INTERVAL = 1000
+        PROGRESS_CHECK_INTERVAL = 250
 
         update_period = 1 / GUI_UPDATE_FREQUENCY
-        updates_per_check = int(GUI_UPDATE_FREQUENCY * (PROGRESS_CHECK_INTERVAL / 1000))
+        next_check = monotonic()
 
-        while True:
-            for i in range(0, updates_per_check):
-                QCoreApplication.processEvents()
-                sleep(update_period)
+        # Wakes up as soon as the worker is done, otherwise keeps the GUI alive
+        while not self._done.wait(update_period):
+            QCoreApplication.processEvents()
 
-            self._locks["metadata"].acquire()
-            progress = self.progress
-            self._locks["metadata"].release()
+            if monotonic() < next_check:
+                continue
+            next_check = monotonic() + PROGRESS_CHECK_INTERVAL / 1000
 
-            self.progress_bar.setProgress((progress[0] / progress[1]) * 100)
+            progress = self.progress
+            if progress[1] > 0:
+                self.progress_bar.setProgress((progress[0] / progress[1]) * 100)
 
             main_window = QtApplication.getInstance().getMainWindow()
             if main_window is None:
-                return None
-
-            if progress[0] >= progress[1]:
+                self._cancelled.set()
                 self.apply_woodgrain_thread.join()
-                break
+                return None
 
-        Logger.log("d", "[Woodgrain Effect] End processing. " + str(progress[1]) + " iterations performed")
+        self.apply_woodgrain_thread.join()
         self.progress_bar.hide()
+
+        if self.output_gcode is None:
+            Logger.log("d", "[Woodgrain Effect] Stopped, the gcode is left as it was")
+            return data
+
+        Logger.log("d", "[Woodgrain Effect] End processing. " + str(self.progress[1]) + " iterations performed")
         return self.output_gcode
 
 
+    def on_progress_action(self, message, action):
+        if action == "cancel":
+            self._cancelled.set()
+
+
+    def run_woodgrain(self, data):
+        profiler = cProfile.Profile() if self.getSettingValueByKey("profile") else None
+        try:
+            if profiler is None:
+                self.apply_woodgrain(data)
+            else:
+                profiler.runcall(self.apply_woodgrain, data)  # this thread only, not the worker processes
+        except WoodgrainCancelled:
+            Logger.log("d", "[Woodgrain Effect] Cancelled")
+        except Exception:
+            Logger.logException("e", "[Woodgrain Effect] Could not apply the effect")
+        finally:
+            if profiler is not None:
+                self.log_profile(profiler)
+            self._done.set()
+
+
+    def log_profile(self, profiler):
+        stopwatch = getattr(self, "stopwatch", None)
+        if stopwatch is not None:
+            Logger.log("i", "[Woodgrain Effect] Profile:\n" + stopwatch.report())
+        try:
+            folder = os.path.join(Resources.getCacheStoragePath(), "woodgrain")
+            os.makedirs(folder, exist_ok=True)
+            profiler.dump_stats(os.path.join(folder, "apply_woodgrain.pstats"))
+            Logger.log("i", "[Woodgrain Effect] cProfile saved to " + os.path.join(folder, "apply_woodgrain.pstats"))
+        except OSError as e:
+            Logger.log("w", "[Woodgrain Effect] Could not save the cProfile: %s" % e)
 
-    def apply_woodgrain(self, data):
-        lines = []
 
+
+    def apply_woodgrain(self, data):
         if "\r\n" in data[0]:
             eol = "\r\n"
         else:
             eol = "\n"
 
-        for layer in data:
-            gcode_line = layer.split(eol)
-            for line in gcode_line:
-                lines.append(line)
-
         avgTemp = int(self.getSettingValueByKey("avgTemp"))
         tempVariation = float(self.getSettingValueByKey("tempVariation"))
         minTemp = avgTemp - tempVariation
@@ -294,58 +578,66 @@ class Woodgrain_Cura(Script):
         spikinessPower = float(self.getSettingValueByKey("spikinessPower"))
         seed = int(self.getSettingValueByKey("seed"))
         scanForZHop = int(self.getSettingValueByKey("scanForZHop"))
+        workers = int(self.getSettingValueByKey("workers"))
 
         tempCommand = 'M104'
         skipStartZ = 0
 
 
-        def get_value(gcode_line, key, default=None):
-            if not key in gcode_line or (';' in gcode_line and gcode_line.find(key) > gcode_line.find(';')):
-                return default
-            sub_part = gcode_line[gcode_line.find(key) + 1:]
-            m = re.search('^[0-9]+\.?[0-9]*', sub_part)
-            if m is None:
-                return default
-            try:
-                return float(m.group(0))
-            except:
-                return default
-
-
         def get_z(line, default=None):
             if line.startswith(";WoodGraph:"):
                 return default
-            if get_value(line, 'G') == 0 or get_value(line, 'G') == 1:
-                return get_value(line, 'Z', default)
-            else:
-                return default
+            words = parse_line(line).words
+            if words.get('G') in (0, 1):
+                z = words.get('Z')
+                if z is not None:
+                    return z
+            return default
 
 
         minimumChangeZ = 0.1
+        self.stopwatch = Stopwatch()
+        self.stopwatch.start("zscan")
 
+        # A single parse of all the layers: the total height, the Z profile and the moves for the z-hop detection
         maxZ = 0
-        thisZ = 0
-        for line in lines:
-            thisZ = get_z(line)
-            if thisZ is not None:
-                if maxZ < thisZ:
-                    maxZ = thisZ
-
-
-        perlin = self.Perlin(seed=seed)
+        zs = [0]
+        formerZ = -1
+        zMoves = []
+        layerStarts = []  # number of the first line of each layer, then the total line count
+        number = 0
+        for layer in data:
+            layerStarts.append(number)
+            for line in layer.split(eol):
+                thisZ = get_z(line) if "Z" in line else None  # only the lines with a Z word need tokenizing
+                if thisZ is not None:
+                    zMoves.append((number, thisZ))
+                    if maxZ < thisZ:
+                        maxZ = thisZ
+
+                    if thisZ > 2 + formerZ:
+                        formerZ = thisZ
+                    elif abs(thisZ - formerZ) > minimumChangeZ and thisZ > skipStartZ:
+                        formerZ = thisZ
+                        zs.append(thisZ)
+                number += 1
+        layerStarts.append(number)
+        self.stopwatch.count(number)
 
 
-        def perlin_to_normalized_wood(z):
+        def perlin_to_normalized_woods(zs):
+            # All the Z profile in one vectorized call
             banding = 3
             octaves = 3
             persistence = 0.6
 
             # 3D sampling with gentle XY drift
+            z = np.asarray(zs, dtype=float)
             x = seed * 0.731 + z * 0.15
             y = seed * 0.193 + z * 0.15 * 0.7
             z_scaled = z / (grainSize * 2)
 
-            noise = banding * perlin.fractal(
+            noise = banding * perlin.fractal_batch(
                 octaves,
                 persistence,
                 x,
@@ -353,63 +645,40 @@ class Woodgrain_Cura(Script):
                 z_scaled
             )
 
-            noise = (noise - math.floor(noise))
-            noise = math.pow(noise, spikinessPower)
-            return noise
+            noise = (noise - np.floor(noise))
+            return [math.pow(n, spikinessPower) for n in noise.tolist()]  # rounds exactly like math.pow always did
 
 
-        noises = {}
-        noises[0] = perlin_to_normalized_wood(0)
-        pendingNoise = None
-        formerZ = -1
-        for line in lines:
-            thisZ = get_z(line, formerZ)
+        self.stopwatch.start("noise", len(zs))
+        # The normalized profile only depends on these settings and on the Z set: reuse it when we can
+        profileCache = ProfileCache(os.path.join(Resources.getCacheStoragePath(), "woodgrain"))
+        profileKey = ProfileCache.key(("woodgrain", seed, grainSize, spikinessPower), zs)
+        noises = profileCache.get(profileKey, zs)
+        if noises is None:
+            perlin = self.Perlin(seed=seed)
+            noises = dict(zip(zs, perlin_to_normalized_woods(zs)))
 
-            if thisZ > 2 + formerZ:
-                formerZ = thisZ
-            elif abs(thisZ - formerZ) > minimumChangeZ and thisZ > skipStartZ:
-                formerZ = thisZ
-                noises[thisZ] = perlin_to_normalized_wood(thisZ)
+            noisesMax = noises[max(noises, key=noises.get)]
+            noisesMin = noises[min(noises, key=noises.get)]
+            for z, v in noises.items():
+                noises[z] = (noises[z] - noisesMin) / (noisesMax - noisesMin)
 
-        noisesMax = noises[max(noises, key=noises.get)]
-        noisesMin = noises[min(noises, key=noises.get)]
-        for z, v in noises.items():
-            noises[z] = (noises[z] - noisesMin) / (noisesMax - noisesMin)
+            profileCache.put(profileKey, zs, noises)
 
 
         def noise_to_temp(noise):
             return minTemp + noise * (maxTemp - minTemp)
 
 
-        if scanForZHop > 5:
-            scanForZHop = 5
-
+        # Z and z-hop decision of each move, by line number
+        self.stopwatch.start("zhop", len(zMoves))
+        zHops = {}
+        for number, z, isZHop in ZHopDetector(scanForZHop).scan(zMoves):
+            zHops[number] = (z, isZHop)
+        zMoves = None
 
-        def z_hop_scan_ahead(index, z):
-            if scanForZHop == 0:
-                return False
-            for i in range(scanForZHop):
-                checkZ = get_z(lines[index + i], z)
-                if checkZ < z:
-                    return True
-            return False
+        firstTempCommand = "M104 S" + str(firstTemp)
 
-
-        class write_to_list:
-            def __init__(self):
-                self.content = ""
-            def write(self, chars):
-                self.content += (chars + eol)
-            def get_data(self):
-                list_output = []
-                for line in self.content.split(eol):
-                    list_output.append(line + eol)
-                return list_output
-        f = write_to_list()
-
-
-        f.write(";woodified gcode, see graph at the end - generated on " +
-                datetime.datetime.now().strftime("%Y%m%d-%H%M") + eol)
         warmingTempCommands = "M230 S0" + eol
         t = firstTemp
         if t == 0:
@@ -417,7 +686,6 @@ class Woodgrain_Cura(Script):
         warmingTempCommands += ("%s S%i" + eol) % (tempCommand, t)
         warmingTempCommands += "M230 S1" + eol
         warmingTempCommands += "M116" + eol
-        f.write(warmingTempCommands)
 
         graphStr = ";WoodGraph: Wood temperature graph (from " + str(minTemp) + "C to " + str(
             maxTemp) + "C, grain size " + str(grainSize) + "mm" + ", scanForZHop " + str(scanForZHop) + ")"
@@ -426,87 +694,241 @@ class Woodgrain_Cura(Script):
         graphStr += ":"
         graphStr += eol
 
-        thisZ = -1
-        formerZ = -1
-        warned = 0
+        class Woodifier:
+            # The emission state machine, fed one layer at a time. Its state at the start of a layer is all it
+            # takes to rewrite that layer on its own: a prepass without output records the state at each layer
+            # start, then the layers can be rewritten in any order, e.g. by several processes.
 
-        postponedTempDelta = 0
-        postponedTempLast = None
-        skip_lines = 0
-        total_length = len(lines) - 1
-        for index, line in enumerate(lines):
+            def __init__(self):
+                self.output = []  # None during the prepass
+                self.graph = []
+                self.first_layer_done = False
+                self.warmingTempCommands = warmingTempCommands
+                self.skip_lines = 0
+                self.thisZ = -1
+                self.formerZ = -1
+                self.postponedTempDelta = 0
+                self.postponedTempLast = None
+
+            def state(self):
+                state = dict(self.__dict__)
+                del state["output"], state["graph"]
+                return state
+
+            @classmethod
+            def resume(cls, state):
+                woodifier = cls()
+                woodifier.__dict__.update(state)
+                return woodifier
 
-            self._locks["metadata"].acquire()
+            def write(self, chars):
+                # Temperatures that come before the first layer are dropped on the way, unless they are the first temperature
+                if self.first_layer_done:
+                    if self.output is not None:
+                        self.output.append(chars)
+                        self.output.append(eol)
+                    return
+                for line in chars.split(eol):
+                    if not self.first_layer_done:
+                        if ";LAYER:0" in line:
+                            self.first_layer_done = True
+                        elif "M104" in line and not firstTempCommand in line:
+                            continue
+                    if self.output is not None:
+                        self.output.append(line)
+                        self.output.append(eol)
+
+            def take(self):
+                chunk = "".join(self.output)
+                self.output = []
+                return chunk
+
+            def rewrite(self, number, lines, progress=None):
+                # progress(number) is called at the first line, then it returns the number of the next line to call it at
+                nextReport = number if progress is not None else float("inf")
+                output = self.output
+                warmingTempCommands = self.warmingTempCommands
+                skip_lines = self.skip_lines
+                thisZ = self.thisZ
+                formerZ = self.formerZ
+                postponedTempDelta = self.postponedTempDelta
+                postponedTempLast = self.postponedTempLast
+
+                for line in lines:
+                    if number >= nextReport:
+                        nextReport = progress(number)
+
+                    move = zHops.get(number)
+                    number += 1
+
+                    if move is None and not skip_lines and not ";" in line and not "M" in line and not "m" in line:
+                        # Nothing to decide on this line, keep it as is
+                        if thisZ != maxZ:
+                            thisZ = formerZ
+                        if output is not None:
+                            output.append(line)
+                            output.append(eol)
+                        continue
+
+                    lineZ, lineIsZHop = (None, False) if move is None else move
+
+                    # RAFT TEMPERATURE OVERRIDE BEFORE LAYER 0
+                    if ";LAYER:0" not in line and ("M104" in line or "M109" in line):
+                        if "M104" in line:
+                            self.write("M104 S" + str(raftTemp) + eol)
+                        elif "M109" in line:
+                            self.write("M109 S" + str(raftTemp) + eol)
+                        continue
+
+                    lower = line.lower()
+                    if "; set extruder " in lower:
+                        self.write(line)
+                        self.write(warmingTempCommands)
+                        warmingTempCommands = ""
+                    elif "; M104_M109" in line:
+                        self.write(line)
+                    elif skip_lines > 0:
+                        skip_lines -= 1
+                    elif ";woodified" in lower:
+                        skip_lines = 4
+                    elif not ";woodgraph" in lower:
+                        if thisZ == maxZ:
+                            self.write(line)
+                        elif not "m104" in lower:
+                            thisZ = formerZ if lineZ is None else lineZ
+                            if thisZ != formerZ and thisZ in noises and not lineIsZHop:
+
+                                if firstTemp != 0 and thisZ <= 0.5:
+                                    temp = firstTemp
+                                else:
+                                    temp = noise_to_temp(noises[thisZ])
+
+                                    temp += postponedTempDelta
+                                    postponedTempDelta = 0
+                                    if (postponedTempLast is not None) and (maxDelta > 0) and (temp > postponedTempLast + maxDelta):
+                                        postponedTempDelta = temp - (postponedTempLast + maxDelta)
+                                        temp = postponedTempLast + maxDelta
+                                    if (postponedTempLast is not None) and (maxDelta > 0) and (temp < postponedTempLast - maxDelta):
+                                        postponedTempDelta = postponedTempLast - maxDelta - temp
+                                        temp = postponedTempLast - maxDelta
+                                    if temp > maxTemp:
+                                        postponedTempDelta = 0
+                                        temp = maxTemp
+                                    postponedTempLast = temp
+
+                                    self.write(("%s S%i" + eol) % (tempCommand, temp))
+
+                                formerZ = thisZ
+
+                                t = int(19 * (temp - minTemp) / (maxTemp - minTemp))
+                                self.graph.append(";WoodGraph: Z %03f " % thisZ + "@%3iC | " % temp +
+                                                  '#'*t + '.'*(20 - t) + eol)
+
+                            self.write(line)
+
+                self.warmingTempCommands = warmingTempCommands
+                self.skip_lines = skip_lines
+                self.thisZ = thisZ
+                self.formerZ = formerZ
+                self.postponedTempDelta = postponedTempDelta
+                self.postponedTempLast = postponedTempLast
+
+
+        total_length = layerStarts[-1] - 1
+        PROGRESS_LINES = 4096  # publish the progress every this many lines
+        PROGRESS_CHECK_PERIOD = 0.1  # seconds between two checks for cancellation while waiting for the workers
+
+        def keep_going(index):
+            if self._cancelled.is_set():
+                raise WoodgrainCancelled()
+            return index + PROGRESS_LINES
+
+        def report(index):
             self.progress = (index, total_length)
-            self._locks["metadata"].release()
-
-            # RAFT TEMPERATURE OVERRIDE BEFORE LAYER 0
-            if ";LAYER:0" not in line and ("M104" in line or "M109" in line):
-                if "M104" in line:
-                    f.write("M104 S" + str(raftTemp) + eol)
-                elif "M109" in line:
-                    f.write("M109 S" + str(raftTemp) + eol)
-                continue
-
-
-            if "; set extruder " in line.lower():
-                f.write(line)
-                f.write(warmingTempCommands)
-                warmingTempCommands = ""
-            elif "; M104_M109" in line:
-                f.write(line)
-            elif skip_lines > 0:
-                skip_lines -= 1
-            elif ";woodified" in line.lower():
-                skip_lines = 4
-            elif not ";woodgraph" in line.lower():
-                if thisZ == maxZ:
-                    f.write(line)
-                elif not "m104" in line.lower():
-                    thisZ = get_z(line, formerZ)
-                    if thisZ != formerZ and thisZ in noises and not z_hop_scan_ahead(index, thisZ):
-
-                        if firstTemp != 0 and thisZ <= 0.5:
-                            temp = firstTemp
-                        else:
-                            temp = noise_to_temp(noises[thisZ])
-
-                            temp += postponedTempDelta
-                            postponedTempDelta = 0
-                            if (postponedTempLast is not None) and (maxDelta > 0) and (temp > postponedTempLast + maxDelta):
-                                postponedTempDelta = temp - (postponedTempLast + maxDelta)
-                                temp = postponedTempLast + maxDelta
-                            if (postponedTempLast is not None) and (maxDelta > 0) and (temp < postponedTempLast - maxDelta):
-                                postponedTempDelta = postponedTempLast - maxDelta - temp
-                                temp = postponedTempLast - maxDelta
-                            if temp > maxTemp:
-                                postponedTempDelta = 0
-                                temp = maxTemp
-                            postponedTempLast = temp
-
-                            f.write(("%s S%i" + eol) % (tempCommand, temp))
-
-                        formerZ = thisZ
-
-                        t = int(19 * (temp - minTemp) / (maxTemp - minTemp))
-                        graphStr += ";WoodGraph: Z %03f " % thisZ
-                        graphStr += "@%3iC | " % temp
-                        graphStr += '#'*t + '.'*(20 - t)
-                        graphStr += eol
-
-                    f.write(line)
-        f.write(graphStr + eol)
-
-
-        self._locks["output"].acquire()
-        first_layer_done = False
-        for line in f.get_data():
-            if not first_layer_done:
-                if ";LAYER:0" in line:
-                    first_layer_done = True
-                elif "M104" in line and not ("M104 S" + str(firstTemp)) in line:
-                    continue
+            return keep_going(index)
+
+        def rewrite_layers(woodifier, first, last, progress=None):
+            # One output chunk per layer, as Cura expects
+            chunks = []
+            for k in range(first, last):
+                woodifier.rewrite(layerStarts[k], data[k].split(eol), progress)
+                chunks.append(woodifier.take())
+            return chunks
+
+        def rewrite_layers_in_worker(state, first, last, sender):
+            # Runs in a forked process, which already holds the data and the profile
+            sender.send(rewrite_layers(Woodifier.resume(state), first, last))
+            sender.close()
+
+
+        self.stopwatch.start("emission", layerStarts[-1])
+        woodifier = Woodifier()
+        woodifier.write(";woodified gcode, see graph at the end - generated on " +
+                        datetime.datetime.now().strftime("%Y%m%d-%H%M") + eol)
+        woodifier.write(warmingTempCommands)
+        header = woodifier.take()
+
+        # No more workers than CPUs to run them: else they only add the prepass and the forks to the serial time
+        # (on 1 CPU, 2 workers took 1.24s where the serial path took 0.66s)
+        cpus = len(os.sched_getaffinity(0)) if hasattr(os, "sched_getaffinity") else (os.cpu_count() or 1)
+        workers = min(workers, cpus, len(data))
+        # Forking is only safe on Linux: macOS has it too, but forking a Qt process from a thread is not
+        if workers > 1 and sys.platform.startswith("linux"):
+            # The cheap prepass: no output, and plain lines are only looked at, to know the state at each layer start
+            self.stopwatch.start("prepass", layerStarts[-1])
+            woodifier.output = None
+            states = []
+            for k in range(len(data)):
+                states.append(woodifier.state())
+                woodifier.rewrite(layerStarts[k], data[k].split(eol), keep_going)
+            woodifier.output = []
+            self.stopwatch.start("emission")
+
+            # Contiguous ranges of layers of about the same size, one per worker
+            size = sum(len(layer) for layer in data)
+            bounds = [0]
+            done = 0
+            for k in range(len(data) - 1):
+                done += len(data[k])
+                if len(bounds) < workers and done * workers >= size * len(bounds):
+                    bounds.append(k + 1)
+            bounds.append(len(data))
+
+            context = multiprocessing.get_context("fork")
+            jobs = []
+            for first, last in zip(bounds, bounds[1:]):
+                receiver, sender = context.Pipe(duplex=False)
+                worker = context.Process(target=rewrite_layers_in_worker, args=(states[first], first, last, sender), daemon=True)
+                worker.start()
+                sender.close()
+                jobs.append((first, last, worker, receiver))
+
+            output = []
+            try:
+                for first, last, worker, receiver in jobs:
+                    while not receiver.poll(PROGRESS_CHECK_PERIOD):
+                        keep_going(layerStarts[first])
+                    try:
+                        chunks = receiver.recv()
+                    except EOFError:
+                        Logger.log("w", "[Woodgrain Effect] A worker process failed, rewriting its layers here")
+                        chunks = rewrite_layers(Woodifier.resume(states[first]), first, last, keep_going)
+                    receiver.close()
+                    worker.join()
+                    output.extend(chunks)
+                    report(layerStarts[last] - 1)
+            finally:
+                for first, last, worker, receiver in jobs:
+                    if worker.is_alive():
+                        worker.terminate()
+        else:
+            output = rewrite_layers(woodifier, 0, len(data), report)
 
-            self.output_gcode.append(line)
+        self.stopwatch.start("footer", len(woodifier.graph) + 1)
+        woodifier.write(graphStr + "".join(woodifier.graph) + eol)
+        output[0] = header + output[0]
+        output[-1] += woodifier.take() + eol
 
-        self._locks["output"].release()
+        self.stopwatch.stop()
+        self.progress = (total_length, total_length)
+        self.output_gcode = output
@@ -0,0 +1,315 @@
+#!/usr/bin/env python3
+# Throughput benchmark of the post-processors over the testing/ gcode corpus and scaled up copies of it.
+#
+# Each run happens in a fresh python process, so that its peak memory is its own. colormix.py is run as it is
+# from the command line, and wood.py through its WoodProcessor, both on a copy of the input; the Cura scripts
+# are loaded with stub Cura modules and their apply_woodgrain() is called directly (the GUI loop of execute()
+# is left out).
+# The scripts time their own stages (read, Z scan, noise, emission, footer, write), which ends up in a JSON
+# report along with the lines per second and the peak memory of each run, e.g.
+#
+#   python3 benchmarks/benchmark.py --scale 1,10 --repeat 3 --output before.json
+#   python3 benchmarks/benchmark.py --scale 1 --synthetic 10M,100M --tools wood,cura --repeat 1
+#
+# Compare two reports to spot a regression. Only the best (fastest) of the repeated runs is kept.
+
+import argparse
+import contextlib
+import importlib.util
+import json
+import os
+import platform
+import re
+import runpy
+import shutil
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+import types
+
+import generate_gcode
+
+try:
+    import resource
+except ImportError:
+    resource = None  # no peak memory on Windows
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+TOOLS = {
+    "wood": os.path.join(ROOT, "wood", "wood.py"),
+    "colormix": os.path.join(ROOT, "colormix", "colormix.py"),
+    "cura": os.path.join(ROOT, "Woodgrain_Cura.py"),
+    "cura-wood": os.path.join(ROOT, "wood", "Woodgrain_Cura.py"),
+}
+TOOL_ARGUMENTS = {
+    "colormix": ["--mix", "3"],
+}
+WOOD_SETTINGS = {"randomSeed": "1", "cacheDir": None}  # a fixed seed, and the noise stage is always computed
+INPUTS = [
+    os.path.join(ROOT, "wood", "testing", "wood_cylinder_source.gcode"),
+    os.path.join(ROOT, "wood", "testing", "z_hop_to_fix_source.gcode"),
+]
+
+MOVE_Z = re.compile(r'^(G[01](?:\s|;|$)[^;]*?Z)([0-9]*\.?[0-9]+)')
+LAYER = re.compile(r'^;LAYER:(-?[0-9]+)')
+
+
+def scale_gcode(source, factor, target):
+    # Stack factor copies of the print on top of each other, so that the scaled file keeps realistic layers,
+    # z-hops and ;LAYER: markers
+    with open(source, "r") as f:
+        lines = f.readlines()
+    height = 0
+    layers = 0
+    for line in lines:
+        match = MOVE_Z.match(line)
+        if match:
+            height = max(height, float(match.group(2)))
+        match = LAYER.match(line)
+        if match:
+            layers = max(layers, int(match.group(1)) + 1)
+    with open(target, "w") as f:
+        for copy in range(factor):
+            for line in lines:
+                if copy:
+                    match = MOVE_Z.match(line)
+                    if match:
+                        z = float(match.group(2)) + copy * height
+                        line = match.group(1) + ("%.3f" % z) + line[match.end():]
+                    match = LAYER.match(line)
+                    if match:
+                        line = ";LAYER:%i" % (int(match.group(1)) + copy * layers) + line[match.end():]
+                f.write(line)
+
+
+def peak_memory_kb():
+    if resource is None:
+        return None
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return peak // 1024 if sys.platform == "darwin" else peak  # bytes on macOS, kilobytes elsewhere
+
+
+def stage_report(stages):
+    report = {}
+    for name, (wall, cpu, count) in stages.items():
+        report[name] = {"wall": wall, "cpu": cpu, "count": count,
+                        "per_second": count / wall if count and wall > 0 else None}
+    return report
+
+
+def run_script(tool, path):
+    # colormix.py on a copy of the input as from the command line, wood.py through its WoodProcessor
+    work = tempfile.mkdtemp(prefix="gcode_benchmark.")
+    try:
+        target = os.path.join(work, os.path.basename(path))
+        shutil.copyfile(path, target)
+        if tool == "wood":
+            processor = runpy.run_path(TOOLS[tool])["WoodProcessor"](**WOOD_SETTINGS)
+            start = time.perf_counter()
+            processor.woodify(target)
+            return time.perf_counter() - start, processor.stopwatch.stages
+        sys.argv = [TOOLS[tool]] + TOOL_ARGUMENTS[tool] + ["--file", target]
+        start = time.perf_counter()
+        with open(os.devnull, "w") as quiet, contextlib.redirect_stdout(quiet):
+            namespace = runpy.run_path(TOOLS[tool], run_name="__main__")
+        seconds = time.perf_counter() - start
+        return seconds, namespace["stopwatch"].stages
+    finally:
+        shutil.rmtree(work)
+
+
+def load_cura_script(path, cache):
+    # Just enough of Cura for the script to load: its relative "..Script" import, the Cura modules it uses
+    # and the Script base class that serves the settings
+    def module(name, **attributes):
+        m = types.ModuleType(name)
+        m.__path__ = []
+        m.__dict__.update(attributes)
+        sys.modules[name] = m
+        return m
+
+    class Script:
+        def __init__(self):
+            self.settings = {}
+
+        def getSettingValueByKey(self, key):
+            return self.settings[key]
+
+    class Logger:
+        @staticmethod
+        def log(*args):
+            pass
+
+    class Resources:
+        @staticmethod
+        def getCacheStoragePath():
+            return cache
+
+    module("UM")
+    module("UM.Logger", Logger=Logger)
+    module("UM.Message", Message=object)
+    module("UM.Resources", Resources=Resources)
+    module("UM.Qt")
+    module("UM.Qt.QtApplication", QtApplication=object)
+    module("PyQt6")
+    module("PyQt6.QtCore", QCoreApplication=object)
+    module("cura_benchmark")
+    module("cura_benchmark.Script", Script=Script)
+    module("cura_benchmark.scripts")
+
+    spec = importlib.util.spec_from_file_location("cura_benchmark.scripts.Woodgrain_Cura", path)
+    script = importlib.util.module_from_spec(spec)
+    sys.modules[spec.name] = script
+    spec.loader.exec_module(script)
+    return script
+
+
+def run_cura(tool, path):
+    # apply_woodgrain() on the layers of the input, split on ;LAYER: like Cura hands them over
+    cache = tempfile.mkdtemp(prefix="gcode_benchmark.")
+    try:
+        plugin = load_cura_script(TOOLS[tool], cache).Woodgrain_Cura()
+        settings = json.loads(plugin.getSettingDataString())["settings"]
+        plugin.settings = dict((key, setting.get("value", setting.get("default_value")))
+                               for key, setting in settings.items())
+        plugin._cancelled = threading.Event()
+
+        start = time.perf_counter()
+        read_start = (time.perf_counter(), time.process_time())
+        with open(path, "r") as f:
+            text = f.read()
+        data = re.split(r'(?=^;LAYER:)', text, flags=re.MULTILINE)
+        read = [time.perf_counter() - read_start[0], time.process_time() - read_start[1], text.count("\n")]
+        text = None
+
+        plugin.apply_woodgrain(data)
+
+        write_start = (time.perf_counter(), time.process_time())
+        with open(os.path.join(cache, "output.gcode"), "w") as f:
+            f.write("".join(plugin.output_gcode))
+        write = [time.perf_counter() - write_start[0], time.process_time() - write_start[1], 0]
+        seconds = time.perf_counter() - start
+
+        stages = {"read": read}
+        stages.update(plugin.stopwatch.stages)
+        stages["write"] = write
+        return seconds, stages
+    finally:
+        shutil.rmtree(cache)
+
+
+def run_one(tool, path):
+    # Runs in the child process: prints the JSON result of a single run
+    if tool.startswith("cura"):
+        seconds, stages = run_cura(tool, path)
+    else:
+        seconds, stages = run_script(tool, path)
+    with open(path, "r") as f:
+        lines = sum(1 for line in f)
+    result = {
+        "seconds": seconds,
+        "lines": lines,
+        "bytes": os.path.getsize(path),
+        "lines_per_second": lines / seconds if seconds > 0 else None,
+        "peak_memory_kb": peak_memory_kb(),
+        "stages": stage_report(stages),
+    }
+    sys.stdout.write(json.dumps(result))
+
+
+def benchmark(tool, path, repeat):
+    best = None
+    for run in range(repeat):
+        child = subprocess.run([sys.executable, os.path.abspath(__file__), "--child", tool, path],
+                               stdout=subprocess.PIPE, stderr=subprocess.PIPE, universal_newlines=True)
+        if child.returncode != 0:
+            return {"error": child.stderr.strip().splitlines()[-1] if child.stderr.strip() else "failed"}
+        result = json.loads(child.stdout)
+        if best is None or result["seconds"] < best["seconds"]:
+            best = result
+    return best
+
+
+def environment():
+    try:
+        import numpy
+        numpy_version = numpy.__version__
+    except ImportError:
+        numpy_version = None
+    try:
+        commit = subprocess.run(["git", "-C", ROOT, "rev-parse", "--short", "HEAD"], stdout=subprocess.PIPE,
+                                stderr=subprocess.DEVNULL, universal_newlines=True).stdout.strip() or None
+    except OSError:
+        commit = None
+    return {"python": platform.python_version(), "platform": platform.platform(), "numpy": numpy_version,
+            "cpus": os.cpu_count(), "commit": commit, "date": time.strftime("%Y-%m-%dT%H:%M:%S")}
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Times the gcode post-processors, stage by stage")
+    parser.add_argument("--tools", default=",".join(TOOLS), help="comma separated, among " + ", ".join(TOOLS))
+    parser.add_argument("--scale", default="1,10", help="comma separated factors the inputs are scaled up by")
+    parser.add_argument("--synthetic", default="", help="comma separated sizes (e.g. 10M,1G) of generated Cura and"
+                                                           " PrusaSlicer flavoured inputs, see generate_gcode.py")
+    parser.add_argument("--input", action="append", default=[], help="more gcode files to benchmark (not scaled)")
+    parser.add_argument("--repeat", type=int, default=3, help="runs of each case, the fastest is kept")
+    parser.add_argument("--output", help="JSON report file (default: standard output)")
+    parser.add_argument("--child", nargs=2, metavar=("TOOL", "FILE"), help=argparse.SUPPRESS)
+    options = parser.parse_args()
+
+    if options.child:
+        run_one(*options.child)
+        return
+
+    tools = options.tools.split(",")
+    for tool in tools:
+        if tool not in TOOLS:
+            parser.error("unknown tool " + tool)
+
+    work = tempfile.mkdtemp(prefix="gcode_benchmark.")
+    try:
+        inputs = []
+        for factor in [int(f) for f in options.scale.split(",")]:
+            for source in INPUTS:
+                if factor == 1:
+                    inputs.append((os.path.basename(source), source))
+                else:
+                    root, extension = os.path.splitext(os.path.basename(source))
+                    name = "%s_x%i%s" % (root, factor, extension)
+                    scale_gcode(source, factor, os.path.join(work, name))
+                    inputs.append((name, os.path.join(work, name)))
+        for size in [s for s in options.synthetic.split(",") if s]:
+            for flavor in ["cura", "prusa"]:
+                name = "synthetic_%s_%s.gcode" % (flavor, size)
+                with open(os.path.join(work, name), "w") as f:
+                    generate_gcode.generate(f, flavor, size=generate_gcode.parse_size(size), raft_layers=3)
+                inputs.append((name, os.path.join(work, name)))
+        for path in options.input:
+            inputs.append((os.path.basename(path), os.path.abspath(path)))
+
+        results = []
+        for name, path in inputs:
+            for tool in tools:
+                result = benchmark(tool, path, options.repeat)
+                result.update({"tool": tool, "input": name})
+                results.append(result)
+                if "error" in result:
+                    sys.stderr.write("%-10s %-40s FAILED %s\n" % (tool, name, result["error"]))
+                else:
+                    sys.stderr.write("%-10s %-40s %8.3fs %10.0f lines/s %8s KB\n" % (
+                        tool, name, result["seconds"], result["lines_per_second"], result["peak_memory_kb"]))
+    finally:
+        shutil.rmtree(work)
+
+    report = json.dumps({"environment": environment(), "results": results}, indent=2)
+    if options.output:
+        with open(options.output, "w") as f:
+            f.write(report + "\n")
+    else:
+        print(report)
+
+
+if __name__ == "__main__":
+    main()
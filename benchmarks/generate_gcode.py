@@ -0,0 +1,250 @@
+#!/usr/bin/env python3
+# Synthetic gcode generator for the scaling tests: writes a Cura or PrusaSlicer flavoured print of any height
+# and size, with the features the post-processors care about: ;LAYER: markers (Cura) or ;LAYER_CHANGE / ;Z:
+# (PrusaSlicer), ;TYPE: sections with walls, z-hops on travels, and a raft (negative layers in Cura, skipped Z
+# in PrusaSlicer). The object is a slowly bulging cylinder, its layers are padded with infill up to the
+# requested size, e.g.
+#
+#   python3 benchmarks/generate_gcode.py --size 100M --zhop-every 3 --raft 3 --output big.gcode
+#   python3 benchmarks/generate_gcode.py --flavor prusa --height 200 --size 1G --output huge.gcode
+#
+# The same options always give the same file.
+
+import argparse
+import math
+import sys
+
+CENTER = 100.0
+RADIUS = 25.0
+FILAMENT_PER_MM = 0.0332  # E per mm of a 0.4mm wide, 0.2mm high line of 1.75mm filament
+
+SIZE_SUFFIXES = {"K": 1024, "M": 1024 ** 2, "G": 1024 ** 3}
+
+
+def parse_size(text):
+    text = text.strip().upper().rstrip("B")
+    if text and text[-1] in SIZE_SUFFIXES:
+        return int(float(text[:-1]) * SIZE_SUFFIXES[text[-1]])
+    return int(text)
+
+
+class Flavor:
+    # What tells the slicers apart: the comments around layers and features, and how numbers are written
+
+    def __init__(self, name):
+        self.name = name
+        self.cura = name == "cura"
+
+    def number(self, value, decimals=3):
+        text = "%.*f" % (decimals, value)
+        if not self.cura:  # PrusaSlicer trims its numbers, e.g. "Z.2" or "X100"
+            text = text.rstrip("0").rstrip(".")
+            if text.startswith("0."):
+                text = text[1:]
+            elif text.startswith("-0."):
+                text = "-" + text[2:]
+            text = text or "0"
+        return text
+
+    def header(self, layer_count, layer_height, temperature):
+        if self.cura:
+            return [
+                ";FLAVOR:Marlin",
+                ";TIME:0",
+                ";Filament used: 0m",
+                ";Layer height: %s" % layer_height,
+                ";Generated with generate_gcode.py",
+                "M140 S60",
+                "M105",
+                "M190 S60",
+                "M104 S%i" % temperature,
+                "M105",
+                "M109 S%i" % temperature,
+                "M82 ;absolute extrusion mode",
+                "G28 ;Home",
+                "G92 E0",
+                ";LAYER_COUNT:%i" % layer_count,
+            ]
+        return [
+            "; generated by PrusaSlicer 2.6.0 (generate_gcode.py)",
+            "",
+            "M107",
+            "M140 S60 ; set bed temperature",
+            "M104 S%i ; set temperature" % temperature,
+            "G28 ; home all axes",
+            "M190 S60 ; wait for bed temperature to be reached",
+            "M109 S%i ; set temperature and wait for it to be reached" % temperature,
+            "G21 ; set units to millimeters",
+            "G90 ; use absolute coordinates",
+            "M82 ; use absolute distances for extrusion",
+            "G92 E0",
+        ]
+
+    def footer(self):
+        if self.cura:
+            return [";TIME_ELAPSED:0", "G1 F2700 E0", "M140 S0", "M107", "G91", "G1 Z5", "G90", "M104 S0", "M84",
+                    ";End of Gcode"]
+        return ["M107", "M104 S0 ; turn off temperature", "M140 S0 ; turn off heatbed", "G1 Z220 F600", "M84",
+                "; filament used [mm] = 0"]
+
+    def layer_start(self, number, z, height):
+        if self.cura:
+            return [";LAYER:%i" % number]
+        return [";LAYER_CHANGE", ";Z:%s" % self.number(z), ";HEIGHT:%s" % self.number(height)]
+
+    def feature(self, kind):
+        names = {
+            "raft": ("SUPPORT", "Support material"),
+            "outer": ("WALL-OUTER", "External perimeter"),
+            "inner": ("WALL-INNER", "Perimeter"),
+            "fill": ("FILL", "Internal infill"),
+        }
+        return ";TYPE:" + names[kind][0 if self.cura else 1]
+
+
+class Generator:
+
+    def __init__(self, out, flavor, layer_height, zhop_every, zhop_height):
+        self.out = out
+        self.flavor = flavor
+        self.layer_height = layer_height
+        self.zhop_every = zhop_every
+        self.zhop_height = zhop_height
+        self.e = 0.0
+        self.x = CENTER
+        self.y = CENTER
+        self.z = 0.0
+        self.travels = 0
+        self.written = 0
+
+    def write(self, lines):
+        chunk = "\n".join(lines) + "\n"
+        self.out.write(chunk)
+        self.written += len(chunk)
+
+    def n(self, value, decimals=3):
+        return self.flavor.number(value, decimals)
+
+    def travel(self, lines, x, y):
+        # Retract, optionally hop, move, then come back down and prime
+        self.travels += 1
+        hop = self.zhop_every > 0 and self.travels % self.zhop_every == 0
+        lines.append("G1 F2700 E%s" % self.n(self.e - 0.8, 5))
+        if hop:
+            lines.append("G1 F300 Z%s" % self.n(self.z + self.zhop_height) if self.flavor.cura else
+                         "G1 Z%s F720" % self.n(self.z + self.zhop_height))
+        if self.flavor.cura:
+            lines.append("G0 F9000 X%s Y%s" % (self.n(x), self.n(y)))
+        else:
+            lines.append("G1 X%s Y%s F10800" % (self.n(x), self.n(y)))
+        if hop:
+            lines.append("G1 F300 Z%s" % self.n(self.z) if self.flavor.cura else "G1 Z%s F720" % self.n(self.z))
+        lines.append("G1 F2700 E%s" % self.n(self.e, 5))
+        self.x, self.y = x, y
+
+    def extrude(self, lines, x, y, feedrate=None):
+        self.e += math.hypot(x - self.x, y - self.y) * FILAMENT_PER_MM
+        self.x, self.y = x, y
+        if feedrate is None:
+            lines.append("G1 X%s Y%s E%s" % (self.n(x), self.n(y), self.n(self.e, 5)))
+        elif self.flavor.cura:
+            lines.append("G1 F%i X%s Y%s E%s" % (feedrate, self.n(x), self.n(y), self.n(self.e, 5)))
+        else:
+            lines.append("G1 X%s Y%s E%s F%i" % (self.n(x), self.n(y), self.n(self.e, 5), feedrate))
+
+    def loop(self, lines, kind, radius, points, feedrate):
+        lines.append(self.flavor.feature(kind))
+        self.travel(lines, CENTER + radius, CENTER)
+        for point in range(1, points + 1):
+            angle = 2 * math.pi * point / points
+            self.extrude(lines, CENTER + radius * math.cos(angle), CENTER + radius * math.sin(angle),
+                         feedrate if point == 1 else None)
+
+    def layer(self, number, z, radius, budget, raft=False):
+        # One layer, padded with infill lines until it weighs about budget bytes
+        lines = self.flavor.layer_start(number, z, self.layer_height)
+        if self.flavor.cura:
+            lines.append("G0 F9000 X%s Y%s Z%s" % (self.n(self.x), self.n(self.y), self.n(z)))
+        else:
+            lines.append("G1 Z%s F7800" % self.n(z))
+        self.z = z
+
+        if raft:
+            self.loop(lines, "raft", radius + 5, 64, 1200)
+        else:
+            self.loop(lines, "outer", radius, 96, 1500)
+            self.loop(lines, "inner", radius - 0.4, 96, 1800)
+
+        # Zig-zag infill, across the layer and back as many times as the budget allows
+        lines.append(self.flavor.feature("fill"))
+        inside = radius - 0.8
+        spacing = 2.0 if not raft else 1.0
+        size = sum(len(line) + 1 for line in lines)
+        count = 0
+        direction = 1 if number % 2 == 0 else -1
+        while size < budget or count == 0:
+            offset = (count * spacing) % (2 * inside) - inside
+            half = math.sqrt(max(inside * inside - offset * offset, 0.01))
+            if number % 2 == 0:
+                start, end = (CENTER - half * direction, CENTER + offset), (CENTER + half * direction, CENTER + offset)
+            else:
+                start, end = (CENTER + offset, CENTER - half * direction), (CENTER + offset, CENTER + half * direction)
+            if count == 0:
+                self.travel(lines, *start)
+                self.extrude(lines, end[0], end[1], 3000)
+            else:
+                self.extrude(lines, start[0], start[1])
+                self.extrude(lines, end[0], end[1])
+            size += len(lines[-1]) * 2
+            direction = -direction
+            count += 1
+        self.write(lines)
+
+
+def generate(out, flavor="cura", height=50.0, layer_height=0.2, size=10 * 1024 ** 2, zhop_every=4, zhop_height=0.4,
+             raft_layers=0, temperature=210):
+    flavor = Flavor(flavor)
+    layers = max(1, int(round(height / layer_height)))
+    generator = Generator(out, flavor, layer_height, zhop_every, zhop_height)
+    generator.write(flavor.header(layers + raft_layers, layer_height, temperature))
+    budget = max(0, (size - 2048) / float(layers + raft_layers))
+
+    z = 0.0
+    for raft in range(raft_layers):
+        z += 0.3  # rafts are thicker
+        number = raft - raft_layers if flavor.cura else raft
+        generator.layer(number, z, RADIUS + 3, budget, raft=True)
+    z += 0.1  # air gap over the raft
+    for layer in range(layers):
+        z += layer_height
+        radius = RADIUS * (1 + 0.2 * math.sin(math.pi * layer / layers))
+        generator.layer(layer if flavor.cura else layer + raft_layers, z, radius, budget)
+
+    generator.write(flavor.footer())
+    return generator.written
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Writes a synthetic Cura or PrusaSlicer flavoured gcode file")
+    parser.add_argument("--flavor", choices=["cura", "prusa"], default="cura")
+    parser.add_argument("--height", type=float, default=50.0, help="object height in mm (default: 50)")
+    parser.add_argument("--layer-height", type=float, default=0.2, help="in mm (default: 0.2)")
+    parser.add_argument("--size", default="10M", help="approximate file size, e.g. 500K, 100M or 1G (default: 10M)")
+    parser.add_argument("--zhop-every", type=int, default=4, help="z-hop on one travel out of this many, 0 for none")
+    parser.add_argument("--zhop-height", type=float, default=0.4, help="in mm (default: 0.4)")
+    parser.add_argument("--raft", type=int, default=0, help="raft layers (default: none)")
+    parser.add_argument("--temperature", type=int, default=210)
+    parser.add_argument("--output", help="gcode file to write (default: standard output)")
+    options = parser.parse_args()
+
+    out = open(options.output, "w") if options.output else sys.stdout
+    try:
+        generate(out, options.flavor, options.height, options.layer_height, parse_size(options.size),
+                 options.zhop_every, options.zhop_height, options.raft, options.temperature)
+    finally:
+        if options.output:
+            out.close()
+
+
+if __name__ == "__main__":
+    main()
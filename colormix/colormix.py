@@ -6,13 +6,31 @@
 #Param: toolCount(float:0) Or the number of switchable tools (0=off, up to 15)
 #Param: mixSpeed(float:1.0) Rate of change (the bigger the faster)
 #Param: randomSeed(float:2) Start value of the pseudo-random, repeatable texture.
+#Param: minChange(float:0) Only change the mix when a material moved by this many percent points (0=any)
+#Param: minStep(float:0) Only change the mix every this many mm along Z at most (0=any)
 
+import contextlib
+import cProfile
 import inspect
+import itertools
 import sys
 import getopt
+import glob
+import multiprocessing
+import os
 import re
 import math
 import random
+import runpy
+import shutil
+import tempfile
+import threading
+import time
+from collections import namedtuple
+try:
+    import queue
+except ImportError:
+    import Queue as queue  # python 2.7
 
 __author__ = 'Jeremie Francois (jeremie.francois@gmail.com)'
 __date__ = '$Date: 2016/05/24 18:24:13 $'
@@ -31,6 +49,12 @@ __license__ = 'GNU Affero General Public License http://www.gnu.org/licenses/agp
 #
 # Use --random followed by an integer to change the shape of the generated random pattern
 #
+#   mixing.py --mix 3 --min-change 5 --min-step 0.6 --file gcodeFile
+# Sends fewer M163/M164 commands to the firmware: only when a weight moved by 5 points, and every 0.6mm at most
+#
+# With "--file -" it is a filter from the standard input to the standard output, e.g. right after the slicer:
+#   slicer ... | mixing.py --mix 3 --file - > mixed.gcode
+#
 # Latest version: 20151001-191033
 #
 
@@ -39,19 +63,86 @@ def plugin_standalone_usage(my_name):
     print("Usage:")
     print("  "+my_name+" --file stringGcodeFile --extruders integerToolCount --random 123 ")
     print("  "+my_name+" --file stringGcodeFile --mix integerNozzleCount --speed integerPercentage --random 123 )")
+    print("  "+my_name+" --batch directory|'glob*.gcode'|manifest.txt --jobs integerWorkers (other options as above)")
+    print("  "+my_name+" --min-change integerPercentage --min-step floatMm (fewer mixing commands, with --mix)")
+    print("  "+my_name+" --file - (other options as above) filters the standard input to the standard output")
+    print("  "+my_name+" --pipeline (reads and writes the file in threads, for slow e.g. network storage)")
+    print("  "+my_name+" --profile (prints the time of each stage) --profile-dump file.pstats (also saves a cProfile)")
     print("Licensed under CC-BY 2012-2015 by jeremie.francois@gmail.com (www.tridimake.com)")
     sys.exit()
+
+
+def batch_files(source):
+    "A directory (its .gcode files), a manifest (one file per line, relative to the manifest) or a glob pattern"
+    if os.path.isdir(source):
+        return sorted(glob.glob(os.path.join(source, "*.gcode")))
+    if os.path.isfile(source) and not source.lower().endswith(".gcode"):
+        with open(source, "r") as f:
+            entries = [line.strip() for line in f]
+        return [os.path.join(os.path.dirname(source), entry) for entry in entries if entry and not entry.startswith("#")]
+    return sorted(glob.glob(source))
+
+
+def batch_process(job):
+    "Runs this very script on one file, in a worker interpreter that stays warm from one file to the next"
+    script, arguments, path = job
+    start = time.time()
+    sys.argv = [script] + arguments + ["--file", path]
+    try:
+        runpy.run_path(script, run_name="__main__")
+    except SystemExit as e:
+        if e.code:
+            return path, "exited with " + str(e.code), time.time() - start
+    except Exception as e:
+        return path, "%s: %s" % (type(e).__name__, e), time.time() - start
+    return path, None, time.time() - start
+
+
+def run_batch(source, arguments, jobs):
+    "Processes all the files of source with jobs forked workers (or in turn without fork), then reports"
+    paths = batch_files(source)
+    if not paths:
+        sys.stderr.write("no gcode files found in %s\n" % source)
+        return 2
+    work = [(os.path.abspath(sys.argv[0]), arguments, path) for path in paths]
+    pool = None
+    if min(jobs, len(work)) > 1 and hasattr(os, "fork"):
+        if hasattr(multiprocessing, "get_context"):
+            pool = multiprocessing.get_context("fork").Pool(min(jobs, len(work)))
+        else:
+            pool = multiprocessing.Pool(min(jobs, len(work)))  # python 2.7 forks anyway
+        results = pool.imap_unordered(batch_process, work)
+    else:
+        results = map(batch_process, work)
+    failures = 0
+    for path, error, seconds in results:
+        if error is None:
+            print("ok     %7.2fs %s" % (seconds, path))
+        else:
+            failures += 1
+            print("FAILED %7.2fs %s: %s" % (seconds, path, error))
+    if pool is not None:
+        pool.close()
+        pool.join()
+    print("%i files, %i failed" % (len(paths), failures))
+    return 1 if failures else 0
+
+
 try:
     # this variable is defined only when we are being called within Cura
     filename
     insertPlotData=1  # debug for gnuplot
+    profileRun = False
+    profileDump = None
+    pipeline = False
 except NameError:
     # Then, we are called from the command line (not from Cura)
     # trying len(inspect.stack()) > 2 would be less secure btw
     opts, extra_params = getopt.getopt(
         sys.argv[1:],
         'x:m:s:r:f:hd',
-        ['extruders=', 'mix=', 'speed=', 'random=', 'file=', 'help', 'doc'])
+        ['extruders=', 'mix=', 'speed=', 'random=', 'file=', 'help', 'doc', 'batch=', 'jobs=',
+         'min-change=', 'min-step=', 'pipeline', 'profile', 'profile-dump='])
 
     filename = ""
 
@@ -59,7 +150,14 @@ except NameError:
     mixCount = 3
     mixSpeed = 1.0
     randomSeed = 2
+    minChange = 0
+    minStep = 0
     insertPlotData = 0
+    batchSource = None
+    jobs = multiprocessing.cpu_count()
+    profileRun = False
+    profileDump = None
+    pipeline = False
 
     for o, p in opts:
         if o in ['-f', '--file']:
@@ -74,6 +172,27 @@ except NameError:
             toolCount = int(p)
         elif o in ['-d', '--doc']:
             insertPlotData = 1
+        elif o == '--min-change':
+            minChange = float(p)
+        elif o == '--min-step':
+            minStep = float(p)
+        elif o == '--batch':
+            batchSource = p
+        elif o == '--jobs':
+            jobs = int(p)
+        elif o == '--pipeline':
+            pipeline = True
+        elif o == '--profile':
+            profileRun = True
+        elif o == '--profile-dump':
+            profileRun = True
+            profileDump = p
+    if batchSource:
+        batchArguments = []
+        for o, p in opts:
+            if o not in ['-f', '--file', '--batch', '--jobs']:
+                batchArguments += [o, p] if p else [o]
+        sys.exit(run_batch(batchSource, batchArguments, jobs))
     if not filename:
         plugin_standalone_usage(inspect.stack()[0][1])
 
@@ -81,35 +200,330 @@ except NameError:
 # ########### END CURA PLUGIN STAND-ALONIFICATION ############
 
 
-def get_value(line, key, default=None):
-    if (key not in line) or (';' in line and line.find(key) > line.find(';')):
-        return default
-    sub_part = line[line.find(key) + 1:]
-    m = re.search('^[0-9]+\.?[0-9]*', sub_part)
-    if m is None:
-        return default
+# A gcode word is an upper case letter followed by an (unsigned) number, e.g. "G1", "Z0.2" or "F.5"
+GCODE_WORD = re.compile(r'([A-Z])([0-9]+\.?[0-9]*|\.[0-9]+)?')
+GcodeLine = namedtuple('GcodeLine', ['command', 'words', 'comment'])
+
+
+def parse_line(line):
+    "Tokenizes the line once: command (e.g. G1), words as {letter: value} and comment offset (-1 if none)"
+    comment = line.find(';')
+    code = line if comment < 0 else line[:comment]
+    words = {}
+    command = None
+    if code and not code.isspace():
+        for key, value in GCODE_WORD.findall(code):
+            if key not in words:  # only the first occurrence counts
+                words[key] = float(value) if value else None
+                if command is None:
+                    command = key + value
+    return GcodeLine(command, words, comment)
+
+
+def get_move_z(line, default=None):
+    "Returns (is_move, z) where z is the Z word of a G0/G1 move, or default"
+    words = parse_line(line).words
+    if words.get('G') not in (0, 1):
+        return False, default
+    z = words.get('Z')
+    return True, (default if z is None else z)
+
+
+replace_file = getattr(os, "replace", os.rename)  # python 2.7 has no atomic replace, but rename is on posix
+
+
+@contextlib.contextmanager
+def replacing(filename):
+    "Writes to a temporary file next to filename, then renames it over filename: a failure leaves filename as it was"
+    fd, tmpname = tempfile.mkstemp(prefix=os.path.basename(filename) + ".", suffix=".tmp",
+                                   dir=os.path.dirname(os.path.abspath(filename)))
     try:
-        return float(m.group(0))
-    except ValueError:
-        return default
+        with os.fdopen(fd, "w") as f:
+            yield f
+        if os.path.exists(filename):
+            shutil.copymode(filename, tmpname)
+        else:
+            umask = os.umask(0)  # the umask can only be read by setting it
+            os.umask(umask)
+            os.chmod(tmpname, 0o666 & ~umask)
+        replace_file(tmpname, filename)
+    except:
+        os.remove(tmpname)
+        raise
+
+
+def spooled(lines, spool):
+    "The lines, also written to the spool file"
+    for line in lines:
+        spool.write(line)
+        yield line
+
+
+wall_clock = getattr(time, "perf_counter", None) or time.time  # python 2.7 has neither perf_counter
+cpu_clock = getattr(time, "process_time", None) or time.clock  # nor process_time
+
+
+class Stopwatch:
+    "Wall and CPU time of the successive stages of a run, and the lines each went through"
+
+    def __init__(self):
+        self.stages = {}  # name: [wall seconds, cpu seconds, lines]
+        self.current = None
+
+    def start(self, name, count=0):
+        "Ends the former stage, if any, and starts this one (a stage run twice adds up)"
+        self.stop()
+        self.stages.setdefault(name, [0.0, 0.0, 0])[2] += count
+        self.current = (name, wall_clock(), cpu_clock())
+
+    def count(self, count):
+        self.stages[self.current[0]][2] += count
+
+    def stop(self):
+        if self.current is not None:
+            name, wall, cpu = self.current
+            stage = self.stages[name]
+            stage[0] += wall_clock() - wall
+            stage[1] += cpu_clock() - cpu
+            self.current = None
+
+    def report(self, title):
+        "The stages as a table, with their totals and the lines per second of each"
+        lines = ["Profile of " + title + ":",
+                 "  %-10s %10s %10s %10s %12s" % ("stage", "wall s", "cpu s", "lines", "lines/s")]
+        for name, (wall, cpu, count) in self.stages.items():
+            rate = "%12.0f" % (count / wall) if count and wall > 0 else "%12s" % "-"
+            lines.append("  %-10s %10.4f %10.4f %10i %s" % (name, wall, cpu, count, rate))
+        lines.append("  %-10s %10.4f %10.4f" % ("total", sum(s[0] for s in self.stages.values()),
+                                                 sum(s[1] for s in self.stages.values())))
+        return "\n".join(lines) + "\n"
+
+
+class ReadAhead:
+    "The chunks (lists) of lines of a file, read by a thread into a bounded queue while the former ones are processed"
+
+    CHUNK_BYTES = 1024 * 1024
+    DEPTH = 8  # chunks read ahead at most
+
+    def __init__(self, f):
+        self.f = f
+        self.queue = queue.Queue(self.DEPTH)
+        self.stopped = False
+        self.thread = threading.Thread(target=self.read)
+        self.thread.daemon = True
+        self.thread.start()
+
+    def read(self):
+        try:
+            while not self.stopped:
+                chunk = self.f.readlines(self.CHUNK_BYTES)
+                self.put(chunk)
+                if not chunk:
+                    return
+        except Exception as e:
+            self.put(e)
+
+    def put(self, item):
+        while not self.stopped:  # a consumer that gave up no longer drains the queue
+            try:
+                self.queue.put(item, timeout=0.1)
+                return
+            except queue.Full:
+                pass
+
+    def __iter__(self):
+        while True:
+            chunk = self.queue.get()
+            if isinstance(chunk, Exception):
+                raise chunk
+            if not chunk:
+                return
+            yield chunk
+
+    def keeping(self, keep):
+        "The chunks, also added to the keep list"
+        for chunk in self:
+            keep.extend(chunk)
+            yield chunk
+
+    def lines(self, keep=None):
+        "The lines one by one, also added to the keep list if any"
+        return itertools.chain.from_iterable(self if keep is None else self.keeping(keep))
+
+    def close(self):
+        self.stopped = True
+        self.thread.join()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exception):
+        self.close()
+
+
+class WriteBehind:
+    "Writes to a file from a thread: write() only buffers, writelines() and paced() hand it off every CHUNK_LINES"
+
+    CHUNK_LINES = 16384
+    DEPTH = 8  # chunks waiting to be written at most
+
+    def __init__(self, f):
+        self.f = f
+        self.buffer = []
+        self.write = self.buffer.append
+        self.queue = queue.Queue(self.DEPTH)
+        self.error = None
+        self.thread = threading.Thread(target=self.drain)
+        self.thread.daemon = True
+        self.thread.start()
+
+    def drain(self):
+        while True:
+            chunk = self.queue.get()
+            if chunk is None:
+                return
+            if self.error is None:  # after an error, the chunks are only drained
+                try:
+                    self.f.write(chunk)
+                except Exception as e:
+                    self.error = e
+
+    def handoff(self):
+        if self.error is not None:
+            raise self.error
+        if self.buffer:
+            self.queue.put("".join(self.buffer))
+            del self.buffer[:]  # the same list, which write() appends to
+
+    def blocks(self, lines):
+        "The lines in lists of CHUNK_LINES, what was written meanwhile being handed off after each of them"
+        lines = iter(lines)
+        while True:
+            block = list(itertools.islice(lines, self.CHUNK_LINES))
+            if not block:
+                return
+            yield block
+            self.handoff()
+
+    def paced(self, lines):
+        "The lines one by one, for a loop that write()s as it goes"
+        return itertools.chain.from_iterable(self.blocks(lines))
+
+    def writelines(self, lines):
+        for block in self.blocks(lines):
+            self.buffer.extend(block)
+
+    def close(self):
+        "Waits for the writes, and raises their error if any"
+        try:
+            self.handoff()
+        finally:
+            self.queue.put(None)
+            self.thread.join()
+        if self.error is not None:
+            raise self.error
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exception):
+        self.close()
+
+
+class MixLimiter:
+    "Holds new mixing weights back until one moved by minChange points, and Z by minStep mm, since the last written"
+
+    def __init__(self, mixCount, minChange, minStep):
+        self.minChange = minChange
+        self.minStep = minStep
+        self.wanted = [-1] * mixCount  # the weights of an unlimited run
+        self.z = None  # of the last weights written
+        self.commands = 0  # M163/M164 of an unlimited run
+        self.written = 0
+
+    def due(self, weights, written, z):
+        "Whether to write the weights of this Z, written being the last ones written"
+        if weights is self.wanted:  # same Z, same decision
+            return False
+        changes = sum(1 for w, l in zip(weights, self.wanted) if w != l)
+        if changes:
+            self.commands += changes + 1
+        self.wanted = weights
+        if weights == written:
+            return False
+        if self.z is not None:  # the first weights always go
+            if max(abs(w - l) for w, l in zip(weights, written)) < self.minChange:
+                return False
+            if abs(z - self.z) < self.minStep:
+                return False
+        self.z = z
+        self.written += sum(1 for w, l in zip(weights, written) if w != l) + 1
+        return True
+
+    def report(self):
+        return "suppressed {0} of {1} M163/M164 commands (min change {2:g} points, min step {3:g}mm)".format(
+            self.commands - self.written, self.commands, self.minChange, self.minStep)
+
 
 mixCount = int(mixCount)
 toolCount = int(toolCount)
 
 random.seed(randomSeed)
 
-with open(filename, "r") as f:
-    lines = f.readlines()
+stopwatch = Stopwatch()
+profiler = None
+if profileDump:
+    profiler = cProfile.Profile()
+    profiler.enable()
+
+# With "--file -", the lines go from the standard input to the standard output as they come. Only the tool
+# mode needs the height of the object first: its lines are spooled into a temporary file during the Z scan.
+streaming = filename == "-"
+spool = None
+if streaming:
+    sys.stdout.flush()  # our own handle writes to the same descriptor
+    file_in = os.fdopen(os.dup(sys.stdin.fileno()), "r")
+    reader = ReadAhead(file_in) if pipeline else None
+    lines = reader.lines() if pipeline else file_in
+    stopwatch.start("zscan")
+    if mixCount == 0:
+        spool = tempfile.TemporaryFile("w+")
+        scanned = spooled(lines, spool)
+    else:
+        scanned = []
+elif pipeline:
+    # the file is read by a thread while the lines already read are scanned, both count as "zscan"
+    stopwatch.start("zscan")
+    lines = []
+    file_in = open(filename, "r")
+    reader = ReadAhead(file_in)
+    scanned = reader.lines(keep=lines)
+else:
+    stopwatch.start("read")
+    with open(filename, "r") as f:
+        lines = f.readlines()
+    stopwatch.count(len(lines))
+    stopwatch.start("zscan", len(lines))
+    scanned = lines
 
 # Find the total height of the object
 maxZ = 0
 z = 0
-for line in lines:
-    gv= get_value(line, 'G', None)
-    if gv is not None and (gv == 0 or gv == 1):
-        z = get_value(line, 'Z', z)
+for line in scanned:
+    is_move, z = get_move_z(line, z)
+    if is_move:
         if maxZ < z:
             maxZ = z
+if spool is not None:
+    spool.seek(0)
+    lines = spool
+elif streaming:
+    maxZ = None  # unknown, the mixes do not need it
+elif pipeline:
+    reader.close()
+    file_in.close()
+    stopwatch.count(len(lines))
+stopwatch.stop()
 
 # print("Max Z is %i" % maxZ)
 
@@ -120,13 +534,19 @@ lastMixes = [-1 for _ in range(mixCount)]
 speedRatio = [0.5 + random.randint(0,100)/100.0 for _ in range(mixCount)]
 mixOffsetDegrees = [360*random.randint(0,100)/100.0 for _ in range(mixCount)]
 
-# lines to remove from the source code
-regexToRemove = '^\s*(;mixing|'
-if toolCount > 0:
-    regexToRemove += 't[0-9]*$'
-else:
-    regexToRemove += 'm163|m164'
-regexToRemove += ')'
+
+def is_stale_line(line):
+    "Lines to remove from the source code: our own former comments, and former tool changes or mixes"
+    code = line.lstrip().lower()
+    if code.startswith(';mixing'):
+        return True
+    if toolCount > 0:
+        # same as a former '^\s*t[0-9]*$' regex (which did not match before a windows EOL)
+        if not code.startswith('t'):
+            return False
+        code = code[1:-1] if code.endswith('\n') else code[1:]
+        return code == '' or code.isdigit()
+    return code.startswith(('m163', 'm164'))
 
 
 def mix_cycle(normalizedIndex, speed, offsetDegree):
@@ -137,68 +557,102 @@ def mix_cycle(normalizedIndex, speed, offsetDegree):
     return int(math.floor(100 * amplitude))
 
 
-file_out = open(filename, "w")
-with file_out as f:
+def mix_weights(z):
+    "The M163 weights (percents adding up to 100) of the materials at this Z, [] when none is set"
+    # z is not divided by maxZ as stripes thickness should stay independent of the geometry!
+    mf = [mix_cycle(z * mixSpeed / 20, speedRatio[i], mixOffsetDegrees[i]) for i in range(mixCount)]
+    t = float(sum(mf))
+    weights = []
+    if t:
+        fix = 0
+        for i in range(mixCount):
+            if i < mixCount - 1:
+                pc = round(100 * mf[i] / t)
+                fix += pc
+            else:
+                pc = 100 - fix
+            weights.append(pc)
+    return weights
+
+
+def tool_index(z):
+    "The tool of this Z: the change in tool index is continuous so you can pre-define shades"
+    zn = z / maxZ  # we need a normalized value
+    return int(toolCount * zn)
+
+
+# Most moves share their Z with the former ones: the tool or weights are computed once per distinct Z
+zTable = {}
+zFunction = tool_index if mixCount == 0 else mix_weights
+limiter = MixLimiter(mixCount, minChange, minStep) if mixCount and (minChange or minStep) else None
+
+
+stopwatch.start("emission", 0 if streaming else len(lines))
+output = os.fdopen(os.dup(sys.stdout.fileno()), "w") if streaming else replacing(filename)
+# with pipeline, f buffers the lines that a thread writes into file_out block by block
+with output as file_out, (WriteBehind(file_out) if pipeline else file_out) as f:
     f.write(";mixing : ")
     if mixCount == 0:
         f.write("switching among {0} tools, every {1:.2f}mm".format(toolCount, maxZ/toolCount))
     else:
         f.write("mixing {0} materials along Z axis".format(mixCount))
-    f.write(" (total height is {0:.2f}mm)\n".format(maxZ))
+    if maxZ is not None:
+        f.write(" (total height is {0:.2f}mm)".format(maxZ))
+    f.write("\n")
 
-    for line in lines:
-        gv= get_value(line, 'G', None)
-        if gv is not None and (gv == 0 or gv == 1):
-            z = float(get_value(line,'Z',z))
+    for line in (f.paced(lines) if pipeline else lines):
+        is_move, z = get_move_z(line, z)
+        if is_move:
+            z = float(z)
+            zValue = zTable.get(z)
+            if zValue is None:
+                zValue = zTable[z] = zFunction(z)
             if mixCount == 0:
                 # switches "tools", that need to be pre-configured for specific mixing levels
-                # The change in tool index is continuous so you can pre-define shades.
-                zn = z / maxZ  # we need a normalized value
-                # print("Z={0}".format(zn))
-                extruder = int(toolCount * zn)
-                if extruder != lastExtruder:
-                    lastExtruder = extruder
-                    f.write("T%i\n" % extruder)
-            else:
-                # z is not divided by maxZ as stripes thickness should stay independent of the geometry!
-                # compute all 3 offsets for this Z
-                mf = [0.0] * mixCount
-                t = 0.0
+                if zValue != lastExtruder:
+                    lastExtruder = zValue
+                    f.write("T%i\n" % zValue)
+            elif zValue and (zValue != lastMixes if limiter is None else limiter.due(zValue, lastMixes, z)):
                 for i in range(mixCount):
-                    a = mix_cycle(z * mixSpeed / 20, speedRatio[i], mixOffsetDegrees[i])
-                    t += a
-                    mf[i]= a
-                if t:
-                    fix = 0
-                    didChange = 0
+                    if zValue[i] != lastMixes[i]:
+                        f.write("M163 S{0} {1}\n".format(i, zValue[i]))
+                lastMixes = zValue
+                f.write("M164 S0\n")  # "store it" to virtual extruder 0 - Repetier hack?
+                if insertPlotData:
+                    # helps to plot the curves (grep + gnuplot), e.g. with:
+                    #
+                    # grep ';mixing_plot' $f |awk '{print $2 "\t" $3 "\t" $4 "\t" $5}' |sed '0,/^0/d' > /tmp/mix.dat
+                    # gnuplot -p -e 'set yrange [0 : 100]; plot
+                    #           "/tmp/mix.dat" using 1:2 title "C" with lines,
+                    #           "/tmp/mix.dat" using 1:3 title "Y" with lines,
+                    #           "/tmp/mix.dat" using 1:4 title "M" with lines'
+
+                    f.write(";mixing_plot\t{0}\t".format(z))
                     for i in range(mixCount):
-                        if i < mixCount - 1:
-                            pc = round(100 * mf[i] / t)
-                            fix += pc
-                        else:
-                            pc = 100 - fix
-                        if pc != lastMixes[i]:
-                            lastMixes[i] = pc
-                            f.write("M163 S{0} {1}\n".format(i,pc))
-                            didChange = 1
-                    if didChange:
-                        f.write("M164 S0\n")  # "store it" to virtual extruder 0 - Repetier hack?
-                        if insertPlotData:
-                            # helps to plot the curves (grep + gnuplot), e.g. with:
-                            #
-                            # grep ';mixing_plot' $f |awk '{print $2 "\t" $3 "\t" $4 "\t" $5}' |sed '0,/^0/d' > /tmp/mix.dat
-                            # gnuplot -p -e 'set yrange [0 : 100]; plot
-                            #           "/tmp/mix.dat" using 1:2 title "C" with lines,
-                            #           "/tmp/mix.dat" using 1:3 title "Y" with lines,
-                            #           "/tmp/mix.dat" using 1:4 title "M" with lines'
-
-                            f.write(";mixing_plot\t{0}\t".format(z))
-                            for i in range(mixCount):
-                                f.write("{0}\t".format(lastMixes[i]))
-                            f.write("\n")
+                        f.write("{0}\t".format(lastMixes[i]))
+                    f.write("\n")
 
             f.write(line)
 
-        elif not re.search(regexToRemove, line, re.IGNORECASE):
+        elif not is_stale_line(line):
             # discard any previous tool change
             f.write(line)
+
+    if limiter is not None:
+        f.write(";mixing : {0}\n".format(limiter.report()))
+    stopwatch.start("write")
+stopwatch.stop()
+if limiter is not None:
+    sys.stderr.write(limiter.report() + "\n")
+if streaming:
+    if reader is not None:
+        reader.close()
+    file_in.close()
+    if spool is not None:
+        spool.close()
+
+if profiler is not None:
+    profiler.disable()
+    profiler.dump_stats(profileDump)
+if profileRun:
+    sys.stderr.write(stopwatch.report(filename))
@@ -1,13 +1,33 @@
+"""Heatmap of the temperature of each layer of a woodified gcode file.
+
+Run it without arguments to be asked for a file and see its heatmap in a window, or from the command line
+(matplotlib is only imported when something is drawn, with its Agg backend unless a window is wanted), e.g.
+
+    python3 Woodgrain_Visualiser.py print.gcode                     # window
+    python3 Woodgrain_Visualiser.py print.gcode -o print.svg        # PNG or SVG, from the extension
+    python3 Woodgrain_Visualiser.py prints/ *.gcode --format png --jobs 8 --output-dir renders/
+    python3 Woodgrain_Visualiser.py print.gcode --text              # no matplotlib at all
+
+Files that end with the WoodGraph footer of wood.py or Woodgrain_Cura are read from it (and their first
+layer) alone, others are parsed whole (see --no-footer). Both take the Z at ;LAYER:1 as 0, but the footer
+has one row per Z of the graph, with the temperature set there, while the whole file gives one row per
+;LAYER: marker, with the Z and temperature current at the marker (i.e. those of the layer before it).
+"""
+
+import argparse
+import glob
+import itertools
+import multiprocessing
+import os
 import re
+import sys
+from array import array
 import numpy as np
-import matplotlib.pyplot as plt
 
 # ============================================================
 # ================= USER SETTINGS ============================
 # ============================================================
 
-# Path to G-code file
-GCODE_FILE = input("""Input the name of the gcode file (in the form path/gcode_file.gcode): """)
 COLOURMAP = "copper_r"
 # COLOURMAP = "bwr"
 
@@ -19,77 +39,179 @@ TOTAL_HEIGHT_MM = None  # None = auto-detect from gcode
 # If None, auto-detect from G-Code layer changes
 LAYER_HEIGHT_MM = None
 
+# Rows of the heatmap at most (layers are averaged together beyond that)
+# If None, the pixel height of the figure
+MAX_ROWS = None
+
 
 
 # ============================================================
 # ==================== GCODE PARSING ============================
 # ============================================================
 
-def get_value(line, key):
-    """Extract numeric value after a letter key in gcode."""
-    if key not in line:
-        return None
-    match = re.search(rf"{key}([-+]?[0-9]*\.?[0-9]+)", line)
-    if not match:
-        return None
-    return float(match.group(1))
+# The only lines that matter, each in one match: temperatures (M104/M109 and their first S word), moves
+# (G0/G1 and their first Z word) and layer changes (;LAYER:, with layer 1 told apart). The numbers are
+# unsigned, like any gcode word: a Z-1 move is ignored.
+NUMBER = rb"([0-9]+\.?[0-9]*|\.[0-9]+)?"
+LINE_OF_INTEREST = re.compile(
+    rb"^[ \t]*(?:M10[49][^\n;S]*S" + NUMBER + rb"|G[01][^\n;Z]*Z" + NUMBER + rb"|(;LAYER:)(1\b)?)", re.MULTILINE)
+TEMP, Z, LAYER, LAYER_1 = 1, 2, 3, 4  # the groups of a match, as its lastindex
 
+CHUNK_BYTES = 4 * 1024 * 1024
+LAYER_SEARCH_BYTES = 1024 * 1024  # searched for a first ;LAYER: marker at most, by the footer path
 
-def parse_gcode_layers(gcode_lines):
-    """Parse gcode and return (layer_z, temp_per_layer)."""
-    layer_zs = []
-    temps = []
 
-    current_temp = None
-    current_z = None
-    layer1_z = None  # <-- use layer 1 as zero
+def lines_of_interest(chunks):
+    """The LINE_OF_INTEREST matches of gcode given as an iterable of bytes chunks, cut anywhere."""
+    rest = b""
+    for chunk in itertools.chain(chunks, [b"\n"]):  # a line break ends the last line, if need be
+        chunk = rest + chunk
+        end = chunk.rfind(b"\n") + 1  # whole lines only, the rest goes with the next chunk
+        rest = chunk[end:]
+        yield from LINE_OF_INTEREST.finditer(chunk, 0, end)
 
-    for line in gcode_lines:
-        line = line.strip()
 
-        # detect temp command
-        if line.startswith("M104") or line.startswith("M109"):
-            temp = get_value(line, "S")
-            if temp is not None:
-                current_temp = temp
+def parse_gcode_layers(chunks):
+    """Parse gcode (an iterable of bytes chunks, cut anywhere) and return (layer_z, temp_per_layer)."""
+    layer_zs = array("d")
+    temps = array("d")
 
-        # detect Z moves
-        if line.startswith("G0") or line.startswith("G1"):
-            z_val = get_value(line, "Z")
-            if z_val is not None:
-                current_z = z_val
+    current_temp = None
+    current_z = None
+    layer1_z = None  # <-- use layer 1 as zero
 
-        # detect layer change
-        if line.startswith(";LAYER:"):
+    for match in lines_of_interest(chunks):
+        found = match.lastindex
+        if found == Z:
+            current_z = float(match.group(Z))
+        elif found == TEMP:
+            current_temp = float(match.group(TEMP))
+        elif found is not None:
             # Capture layer 1 Z height using exact match
-            if re.match(r"^;LAYER:1\b", line):
+            if found == LAYER_1:
                 layer1_z = current_z if current_z is not None else 0
 
             layer_zs.append(current_z if current_z is not None else 0)
             temps.append(current_temp if current_temp is not None else 0)
 
     # Normalize heights so layer 1 = 0
+    layer_zs = np.frombuffer(layer_zs, dtype=float) if len(layer_zs) else np.array([])
     if layer1_z is not None:
-        layer_zs = np.array(layer_zs) - layer1_z
-    else:
-        layer_zs = np.array(layer_zs)
+        layer_zs = layer_zs - layer1_z
 
-    return layer_zs, np.array(temps)
+    return layer_zs, np.frombuffer(temps, dtype=float) if len(temps) else np.array([])
 
 
-def load_gcode(file_path):
-    with open(file_path, "r", encoding="utf-8", errors="ignore") as f:
-        return f.readlines()
+def layer1_height(chunks, search_bytes=LAYER_SEARCH_BYTES):
+    """The Z the full parse takes as zero: the Z at the ;LAYER:1 marker, None without one. The chunks are only
+    read up to that marker, i.e. about the first layers of the file, or up to search_bytes when they have no
+    ;LAYER: marker at all (e.g. PrusaSlicer or Slic3r files, that the full parse gives no layer rows for)."""
+    read = 0
+    layers = False  # whether a ;LAYER: marker was found yet
+
+    def searched():
+        nonlocal read
+        for chunk in chunks:
+            if read >= search_bytes and not layers:
+                return
+            read += len(chunk)
+            yield chunk
+
+    current_z = None
+    for match in lines_of_interest(searched()):
+        if match.lastindex == Z:
+            current_z = float(match.group(Z))
+        elif match.lastindex == LAYER_1:
+            return current_z if current_z is not None else 0
+        elif match.lastindex == LAYER:
+            layers = True
+    return None
+
+
+# The temperature graph wood.py and Woodgrain_Cura write at the end of the file: a header line, then one
+# entry per Z, e.g. ";WoodGraph: Z 0.200000 @210C | #########...........". Cura may add its ;SETTING_ lines
+# after it.
+WOODGRAPH = b";WoodGraph:"
+WOODGRAPH_ENTRY = re.compile(rb";WoodGraph: Z (-?[0-9]+\.?[0-9]*) @ *(-?[0-9]+)C")
+FOOTER_BLOCK_BYTES = 64 * 1024
+
+
+def read_woodgraph_footer(file_path, block_bytes=FOOTER_BLOCK_BYTES):
+    """Read the WoodGraph footer backwards from the end of the file and return (layer_z, temp_per_layer),
+    or None if there is no footer. Only the footer and the first layer (or LAYER_SEARCH_BYTES, in files without
+    ;LAYER: markers) are read, whatever the size of the file.
+
+    Its rows are the Z values of the graph with the temperature set there, while the full parse has one row
+    per ;LAYER: marker with the Z and temperature current at the marker. Both take the Z at ;LAYER:1 as 0."""
+    heights = {}  # Z: temperature, the last one set at each Z
+    with open(file_path, "rb") as f:
+        f.seek(0, os.SEEK_END)
+        position = f.tell()
+        rest = b""  # the first line read so far, which may still be cut
+        while position > 0:
+            size = min(block_bytes, position)
+            position -= size
+            f.seek(position)
+            lines = (f.read(size) + rest).split(b"\n")
+            rest = lines.pop(0) if position > 0 else b""
+            for line in reversed(lines):
+                line = line.strip()
+                if not line or (line.startswith(b";SETTING_") and not heights):
+                    continue
+                if not line.startswith(WOODGRAPH):
+                    return None  # a gcode line before any graph header: no footer
+                match = WOODGRAPH_ENTRY.match(line)
+                if match is None:  # the header, the footer is complete
+                    if not heights:
+                        return None
+                    layer_zs = np.array(sorted(heights))
+                    temps = np.array([heights[z] for z in sorted(heights)])
+                    layer1_z = layer1_height(load_gcode(file_path, block_bytes))
+                    if layer1_z is not None:
+                        layer_zs = layer_zs - layer1_z  # the same zero as the full parse
+                    return layer_zs, temps
+                z = float(match.group(1))
+                if z not in heights:  # read backwards, so the first one seen is the last one set
+                    heights[z] = float(match.group(2))
+    return None
+
+
+def load_gcode(file_path, chunk_bytes=CHUNK_BYTES):
+    """The file as bytes chunks: it is never held in memory as a whole."""
+    with open(file_path, "rb") as f:
+        while True:
+            chunk = f.read(chunk_bytes)
+            if not chunk:
+                return
+            yield chunk
 
 
 # ============================================================
-# ======================= MAIN ===============================
+# ====================== RENDERING ===========================
 # ============================================================
 
-def main():
-    lines = load_gcode(GCODE_FILE)
+def load_pyplot(interactive):
+    """Import matplotlib on first use, with the Agg backend (no display needed) unless a window is wanted."""
+    import matplotlib
+    if not interactive:
+        matplotlib.use("Agg")
+    import matplotlib.pyplot as plt
+    return plt
+
+
+def downsample_layers(layer_zs, temps, rows):
+    """Average runs of consecutive layers into at most rows layers, each at the Z of its first layer."""
+    if len(temps) <= rows:
+        return layer_zs, temps
+    step = -(-len(temps) // rows)
+    starts = np.arange(0, len(temps), step)
+    counts = np.diff(np.append(starts, len(temps)))
+    return layer_zs[starts], np.add.reduceat(temps, starts) / counts
+
 
-    layer_zs, temps = parse_gcode_layers(lines)
+def render(layer_zs, temps, output=None, colourmap=COLOURMAP):
+    """Draw the heatmap, into output (PNG or SVG, from its extension) or else in a window."""
+    plt = load_pyplot(output is None)
 
     # Auto-detect total height
     total_height = TOTAL_HEIGHT_MM if TOTAL_HEIGHT_MM is not None else max(layer_zs)
@@ -103,6 +225,12 @@ def main():
     else:
         layer_height = LAYER_HEIGHT_MM
 
+    figure = plt.figure(figsize=(6, 8))
+
+    # No more rows than the figure has pixels, whatever the layer count
+    rows = MAX_ROWS if MAX_ROWS is not None else int(figure.get_size_inches()[1] * figure.dpi)
+    layer_zs, temps = downsample_layers(layer_zs, temps, max(rows, 2))
+
     # Create grid for pcolormesh
     y = layer_zs
     x = np.array([0, 1])  # two columns for pcolormesh
@@ -114,10 +242,9 @@ def main():
     # Build X/Y meshgrid matching Z's shape
     X, Y = np.meshgrid(x, y)
 
-    plt.figure(figsize=(6, 8))
     mesh = plt.pcolormesh(
         X, Y, temp_matrix,
-        shading="auto", cmap=COLOURMAP
+        shading="auto", cmap=colourmap
     )
 
     cbar = plt.colorbar(mesh)
@@ -134,8 +261,123 @@ def main():
     plt.ylabel("Height (mm)")
     plt.title("G-code Layer Temperature Map")
 
-    plt.show()
+    if output is None:
+        plt.show()
+    else:
+        figure.savefig(output)
+        plt.close(figure)
+
+
+def text_summary(path, layer_zs, temps):
+    """The layers as text, one line each with a bar from the lowest to the highest temperature."""
+    lines = ["%s: %i layers" % (path, len(temps))]
+    if len(temps):
+        low, high = np.min(temps), np.max(temps)
+        lines[0] += ", Z %.3f to %.3fmm, %.1fC to %.1fC" % (np.min(layer_zs), np.max(layer_zs), low, high)
+        for z, temp in zip(layer_zs, temps):
+            t = int(19 * (temp - low) / (high - low)) if high > low else 0
+            lines.append("Z %8.3f @%5.1fC | %s" % (z, temp, "#" * t + "." * (20 - t)))
+    return "\n".join(lines) + "\n"
+
+
+# ============================================================
+# ======================= MAIN ===============================
+# ============================================================
+
+def gcode_files(sources):
+    """Files, directories (their .gcode files) and glob patterns, as a list of files."""
+    files = []
+    for source in sources:
+        if os.path.isdir(source):
+            files += sorted(glob.glob(os.path.join(source, "*.gcode")))
+        elif glob.has_magic(source):
+            files += sorted(glob.glob(source))
+        else:
+            files.append(source)
+    return files
+
+
+def output_path(path, output_dir, file_format):
+    """Where the heatmap of path goes in batch mode: next to it, or in output_dir."""
+    name = os.path.splitext(os.path.basename(path))[0] + "." + file_format
+    return os.path.join(output_dir if output_dir else os.path.dirname(path), name)
+
+
+def read_layers(path, footer=True):
+    """(layer_z, temp_per_layer) of a file, from its WoodGraph footer if it has one, else from the whole file."""
+    layers = read_woodgraph_footer(path) if footer else None
+    if layers is None:
+        layers = parse_gcode_layers(load_gcode(path))
+    return layers
+
+
+def visualise(job):
+    """Render or summarize one file; returns (path, text or output file, error)."""
+    path, output, text, colourmap, footer = job
+    try:
+        layer_zs, temps = read_layers(path, footer)
+        if text:
+            return path, text_summary(path, layer_zs, temps), None
+        if not len(temps):
+            return path, None, "no ;LAYER: found"
+        render(layer_zs, temps, output, colourmap)
+        return path, output, None
+    except Exception as e:
+        return path, None, "%s: %s" % (type(e).__name__, e)
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Heatmap of the temperature of each layer of woodified gcode files")
+    parser.add_argument("files", nargs="*", help="gcode files, directories or glob patterns (asked for if none)")
+    parser.add_argument("-o", "--output", help="image file of a single input, PNG or SVG from its extension")
+    parser.add_argument("--format", choices=["png", "svg"], help="render to files of this format (default: png)")
+    parser.add_argument("--output-dir", help="where to render the images (default: next to each gcode file)")
+    parser.add_argument("--jobs", type=int, default=multiprocessing.cpu_count(), help="files rendered in parallel")
+    parser.add_argument("--text", action="store_true", help="print the layers as text, without matplotlib")
+    parser.add_argument("--no-footer", action="store_true",
+                        help="parse the whole file, even when it ends with a WoodGraph footer: one row per ;LAYER:"
+                             " marker (with the Z and temperature of the layer before it) rather than per graph Z")
+    parser.add_argument("--colourmap", default=COLOURMAP, help="matplotlib colourmap, e.g. bwr (default: %(default)s)")
+    args = parser.parse_args(argv)
+
+    files = gcode_files(args.files)
+    if not args.files:
+        files = [input("""Input the name of the gcode file (in the form path/gcode_file.gcode): """)]
+    if not files:
+        parser.error("no gcode files found in " + ", ".join(args.files))
+    if args.output and len(files) != 1:
+        parser.error("--output needs a single gcode file, see --output-dir for more")
+
+    if len(files) == 1 and not (args.output or args.output_dir or args.format):
+        outputs = [None]  # a window, as it has always been
+    elif args.output:
+        outputs = [args.output]
+    else:
+        outputs = [output_path(path, args.output_dir, args.format or "png") for path in files]
+    if args.output_dir and not args.text and not os.path.isdir(args.output_dir):
+        os.makedirs(args.output_dir)
+
+    jobs = [(path, output, args.text, args.colourmap, not args.no_footer) for path, output in zip(files, outputs)]
+    pool = None
+    if min(args.jobs, len(jobs)) > 1 and outputs[0] is not None:
+        pool = multiprocessing.Pool(min(args.jobs, len(jobs)))
+        results = pool.imap(visualise, jobs)
+    else:
+        results = map(visualise, jobs)
+    failures = 0
+    for path, result, error in results:
+        if error is not None:
+            failures += 1
+            sys.stderr.write("%s: %s\n" % (path, error))
+        elif args.text:
+            sys.stdout.write(result)
+        elif result is not None:
+            print(result)
+    if pool is not None:
+        pool.close()
+        pool.join()
+    return 1 if failures else 0
 
 
 if __name__ == "__main__":
-    main()
+    sys.exit(main())
@@ -0,0 +1,72 @@
+"""Tests of the WoodGraph footer fast path of Woodgrain_Visualiser.py, e.g.
+
+    python3 -m pytest wood/testing
+"""
+
+import importlib.util
+import os
+import runpy
+import shutil
+import tempfile
+import unittest
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+WOOD = os.path.join(HERE, "..", "wood.py")
+
+
+def load_visualiser():
+    path = os.path.join(HERE, "..", "Woodgrain_Visualiser.py")
+    spec = importlib.util.spec_from_file_location("Woodgrain_Visualiser", path)
+    module = importlib.util.module_from_spec(spec)
+    spec.loader.exec_module(module)
+    return module
+
+
+class FooterTest(unittest.TestCase):
+
+    def setUp(self):
+        self.visualiser = load_visualiser()
+        self.directory = tempfile.mkdtemp(prefix="woodgrain_test.")
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+
+    def woodified(self, source, padding=b""):
+        # The source woodified by wood.py, with padding (bytes) inserted right before its first line
+        target = os.path.join(self.directory, os.path.basename(source))
+        runpy.run_path(WOOD)["WoodProcessor"](randomSeed=1, cacheDir=None).woodify(source, target)
+        with open(target, "rb") as f:
+            gcode = f.read()
+        with open(target, "wb") as f:
+            f.write(padding + gcode)
+        return target
+
+    def test_same_zero_as_the_full_parse(self):
+        path = self.woodified(os.path.join(HERE, "wood_cylinder_source.gcode"))
+        footer_zs, footer_temps = self.visualiser.read_woodgraph_footer(path)
+        parsed_zs, parsed_temps = self.visualiser.parse_gcode_layers(self.visualiser.load_gcode(path))
+        self.assertIn(0, list(parsed_zs))
+        self.assertEqual(footer_zs[0], 0)  # layer 0, the Z at ;LAYER:1 in both
+
+    def test_no_layer_markers_read_in_bounded_bytes(self):
+        # PrusaSlicer gcode has no ;LAYER: marker: only a prefix of the file is searched for one, and Z is not shifted
+        padding = b"G1 X1 Y1 E1 ; padding\n" * (8 * self.visualiser.LAYER_SEARCH_BYTES // 22)
+        path = self.woodified(os.path.join(HERE, "z_hop_to_fix_source.gcode"), padding)
+        read = []
+        load_gcode = self.visualiser.load_gcode
+
+        def counted(*args, **kwargs):
+            for chunk in load_gcode(*args, **kwargs):
+                read.append(len(chunk))
+                yield chunk
+        self.visualiser.load_gcode = counted
+
+        layer_zs, temps = self.visualiser.read_woodgraph_footer(path)
+        self.assertGreater(len(temps), 1)
+        self.assertGreater(layer_zs[0], 0)  # not shifted
+        self.assertLessEqual(sum(read), self.visualiser.LAYER_SEARCH_BYTES + self.visualiser.FOOTER_BLOCK_BYTES)
+        self.assertLess(sum(read), os.path.getsize(path) // 4)
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,45 @@
+"""Tests of what WoodProcessor takes as its source in wood.py, e.g.
+
+    python3 -m pytest wood/testing
+"""
+
+import os
+import runpy
+import subprocess
+import sys
+import unittest
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+WOOD = os.path.join(HERE, "..", "wood.py")
+SOURCE = os.path.join(HERE, "wood_cylinder_source.gcode")
+
+
+class SourceTest(unittest.TestCase):
+
+    def setUp(self):
+        self.processor = runpy.run_path(WOOD)["WoodProcessor"](randomSeed=1, cacheDir=None)
+
+    def test_empty_string_is_gcode(self):
+        woodified = self.processor.process("")
+        self.assertTrue(woodified.startswith(";woodified gcode"))
+        self.assertIn(";WoodGraph:", woodified)
+
+    def test_one_line_is_gcode(self):
+        woodified = self.processor.process("G1 Z0.2")
+        self.assertIn("\nG1 Z0.2\n", woodified)  # the graph still starts on a line of its own
+        self.assertIn(";WoodGraph: Z 0.200000 @", woodified)
+
+    def test_existing_path_is_a_file(self):
+        with open(SOURCE, "r") as f:
+            text = f.read()
+        self.assertEqual(self.processor.process(SOURCE).split("\n", 1)[1], self.processor.process(text).split("\n", 1)[1])
+
+    def test_missing_file_is_an_error(self):
+        missing = os.path.join(HERE, "no_such_source.gcode")
+        run = subprocess.run([sys.executable, WOOD, "--file", missing], capture_output=True, text=True)
+        self.assertEqual(run.returncode, 2)
+        self.assertIn("no such file", run.stderr)
+
+
+if __name__ == "__main__":
+    unittest.main()
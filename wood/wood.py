@@ -11,7 +11,7 @@
 #Param: maxDownward(float:0) Instant temperature decrease limit, as some firmwares halt on big drops (C)
 #Param: zOffset(float:0) Vertical shift of the variations, as shown at the end of the gcode file (mm)
 #Param: skipStartZ(float:0) Skip some Z at start of print, i.e. raft height (mm)
-#Param: scanForZHop(int:5) G-code lines to scan ahead for Z-Hop. Max 5 (default), 0 to disable.
+#Param: scanForZHop(int:5) G-code lines to scan ahead for Z-Hop (5 by default, no maximum), 0 to disable.
 #Param: tempCommand(string: M104) In case you want to rely on M109 for example (pause until temperature settles down)
 
 __copyright__ = "Copyright (C) 2012-2017 Jeremie@Francois.gmail.com"
@@ -22,10 +22,25 @@ __license__ = 'GNU Affero General Public License http://www.gnu.org/licenses/agp
 import re
 import random
 import math
+import mmap
+import cProfile
 import datetime
 import inspect
+import itertools
 import sys
 import getopt
+import glob
+import hashlib
+import json
+import multiprocessing
+import os
+import shutil
+import tempfile
+import threading
+import time
+from array import array
+from collections import namedtuple, deque, OrderedDict
+from contextlib import contextmanager
 
 
 ############ BEGIN CURA PLUGIN STAND-ALONIFICATION ############
@@ -51,91 +66,185 @@ def plugin_standalone_usage(myName):
     print("  " + myName
           + " -f gcodeFile (-i minTemp) (-a maxTemp) (-t startTemp) (-g grainSize) (-u deltaTemp) (-r randomSeed)"
           + " (-s spikinessFactor) (-z zOffset)")
+    print("  Add --stream to process huge files with a bounded memory (the file is read twice but never held)")
+    print("  Seeded temperature profiles are cached in (--cache-dir dir), unless --no-cache is given")
+    print("  Sweep mode: (--sweep-seeds 1,2,3) (--sweep-grains 3,5) (--sweep-spikiness 1,2) (--jobs count) parses the file")
+    print("  once and writes one woodified copy per combination next to it, leaving the file itself unchanged")
+    print("  Batch mode: (--batch directory|'glob*.gcode'|manifest.txt) (--jobs count) in place of --file woodifies")
+    print("  many files at once with the same settings, and reports how each of them went")
+    print("  Temperature commands that would not change the (integer) temperature are dropped, unless --keep-redundant")
+    print("  --sidecar pads the temperature commands and lists them in file.wood.json, so that later runs with --sidecar")
+    print("  (and the same --skip-start-z, --scan-for-z-hop and --temp-command) only patch them in place")
+    print("  --pipeline reads and writes the file in threads while processing it, for slow (e.g. network) storage")
+    print("  --profile prints the time of each stage, --profile-dump file also saves a cProfile of the run (pstats)")
     print("Licensed under CC-BY " + __date__[7:26] + " by jeremie.francois@gmail.com (www.tridimake.com)")
     sys.exit()
 
 
-try:
-    filename
-except NameError:
-    # Then we are called from the command line (not from cura)
-    # trying len(inspect.stack()) > 2 would be less secure btw
-    opts, extraparams = getopt.getopt(sys.argv[1:], 'i:a:t:g:u:d:r:s:z:k:c:f:w:h',
-                                      ['min=', 'max=', 'first-temp=', 'grain=', 'max-upward=', 'max-downward=', 'random-seed=',
-                                       'spikiness-power=', 'z-offset=', 'skip-start-z=', 'scan-for-z-hop=', 'temp-command', 'file=', 'help'])
-    minTemp = 190
-    maxTemp = 240
-    firstTemp = 0
-    grainSize = 3
-    maxUpward = 0
-    maxDownward = 0
-    skipStartZ = 0
-    zOffset = 0
-    scanForZHop = 5
-    spikinessPower = 1.0
-    tempCommand = 'M104'
-    waitTemp = False
-    filename = ""
-    for o, p in opts:
-        if o in ['-f', '--file']:
-            filename = p
-        elif o in ['-i', '--min']:
-            minTemp = float(p)
-        elif o in ['-a', '--max']:
-            maxTemp = float(p)
-        elif o in ['-t', '--first-temp']:
-            firstTemp = float(p)
-        elif o in ['-g', '--grain']:
-            grainSize = float(p)
-        elif o in ['-u', '--max-upward']:
-            maxUpward = float(p)
-        elif o in ['-d', '--max-downward']:
-            maxDownward = float(p)
-        elif o in ['-k', '--skip-start-z']:
-            skipStartZ = float(p)
-        elif o in ['-z', '--z-offset']:
-            random.seed(0)
-            zOffset = float(p)
-        elif o in ['-c', '--scan-for-z-hop']:
-            scanForZHop = int(p)
-        elif o in ['-r', '--random-seed']:
-            if p != 0:
-                random.seed(p)
-        elif o in ['-s', '--spikiness-power']:
-            spikinessPower = float(p)
-            if spikinessPower <= 0:
-                spikinessPower = 1.0
-        elif o in ['-w', '--temp-command']:
-            tempCommand = p  # e.g. M109 in place of default M104, see https://www.simplify3d.com/support/articles/3d-printing-gcode-tutorial/#M104-M109
-    if not filename:
-        plugin_standalone_usage(inspect.stack()[0][1])
+def worker_pool(count):
+    # Forked workers inherit everything this process already holds (e.g. the parsed file in sweep mode),
+    # so they are only sent their settings. Where there is no fork, the caller runs its jobs in turn.
+    if count < 2 or not hasattr(os, "fork"):
+        return None
+    if hasattr(multiprocessing, "get_context"):
+        return multiprocessing.get_context("fork").Pool(count)
+    return multiprocessing.Pool(count)  # python 2.7 forks anyway
 
 
-#
-############ END CURA PLUGIN STAND-ALONIFICATION ############
+def batch_files(source):
+    # A directory (its .gcode files), a manifest (one file per line, relative to the manifest) or a glob pattern
+    if os.path.isdir(source):
+        return sorted(glob.glob(os.path.join(source, "*.gcode")))
+    if os.path.isfile(source) and not source.lower().endswith(".gcode"):
+        with open(source, "r") as f:
+            entries = [line.strip() for line in f]
+        return [os.path.join(os.path.dirname(source), entry) for entry in entries if entry and not entry.startswith("#")]
+    return sorted(glob.glob(source))
 
 
-def get_value(gcode_line, key, default=None):
-    if not key in gcode_line or (';' in gcode_line and gcode_line.find(key) > gcode_line.find(';')):
-        return default
-    sub_part = gcode_line[gcode_line.find(key) + 1:]
-    m = re.search('^[0-9]+\.?[0-9]*', sub_part)
-    if m is None:
-        return default
+def batch_process(job):
+    # Woodify one file right in this worker, as main() would from the command line
+    arguments, path = job
+    start = time.time()
     try:
-        return float(m.group(0))
-    except:
-        return default
+        code = main(arguments + ["--file", path])
+    except SystemExit as e:
+        code = e.code
+    except Exception as e:
+        return path, "%s: %s" % (type(e).__name__, e), time.time() - start
+    if code:
+        return path, "exited with " + str(code), time.time() - start
+    return path, None, time.time() - start
 
 
-def get_z(line, default=None):
-    # Support G0 and G1 "move" commands
-    if line.startswith(";WoodGraph:"):
-        return default
-    if get_value(line, 'G') == 0 or get_value(line, 'G') == 1:
-        return get_value(line, 'Z', default)
+def run_batch(source, arguments, jobs):
+    paths = batch_files(source)
+    if not paths:
+        sys.stderr.write("no gcode files found in %s\n" % source)
+        return 2
+    work = [(arguments, path) for path in paths]
+    pool = worker_pool(min(jobs, len(work)))
+    if pool is None:
+        results = map(batch_process, work)
     else:
-        return default
+        results = pool.imap_unordered(batch_process, work)
+    failures = 0
+    for path, error, seconds in results:
+        if error is None:
+            print("ok     %7.2fs %s" % (seconds, path))
+        else:
+            failures += 1
+            print("FAILED %7.2fs %s: %s" % (seconds, path, error))
+    if pool is not None:
+        pool.close()
+        pool.join()
+    print("%i files, %i failed" % (len(paths), failures))
+    return 1 if failures else 0
+
+
+DEFAULT_CACHE_DIR = os.path.join(os.environ.get("XDG_CACHE_HOME") or os.path.join(os.path.expanduser("~"), ".cache"),
+                                 "gcode_postprocessors", "wood")
+
+#
+############ END CURA PLUGIN STAND-ALONIFICATION ############
+
+
+# A gcode word is an upper case letter followed by an (unsigned) number, e.g. "G1", "Z0.2" or "F.5"
+GCODE_WORD = re.compile(r'([A-Z])([0-9]+\.?[0-9]*|\.[0-9]+)?')
+GcodeLine = namedtuple('GcodeLine', ['command', 'words', 'comment'])
+
+
+def parse_line(line):
+    # Tokenize the line once: its command (e.g. "G1"), its words as {letter: value} and the offset of
+    # its comment (-1 if none). Comments and blank lines do not cost any regex call, others cost one.
+    comment = line.find(';')
+    code = line if comment < 0 else line[:comment]
+    words = {}
+    command = None
+    if code and not code.isspace():
+        for key, value in GCODE_WORD.findall(code):
+            if key not in words:  # only the first occurrence counts
+                words[key] = float(value) if value else None
+                if command is None:
+                    command = key + value
+    return GcodeLine(command, words, comment)
+
+
+class ZIndex:
+    # Compact index of the lines that carry a Z word, built in the one and only tokenizing pass over the file:
+    # their line number, their Z and whether they are a G0/G1 move. The noise, z-hop and emission stages
+    # all read from it, so the file is parsed exactly once (and does not need to be held in memory).
+
+    def __init__(self, lines):
+        self.line_numbers = array('l')
+        self.heights = array('d')
+        self.moves = array('b')
+        self.eol = "#"
+        self.line_count = 0
+        for number, line in enumerate(lines):
+            if 'Z' in line:  # no Z word without it: the other lines are not even tokenized
+                words = parse_line(line).words
+                z = words.get('Z')
+                if z is not None:
+                    self.line_numbers.append(number)
+                    self.heights.append(z)
+                    self.moves.append(words.get('G') in (0, 1))  # Support G0 and G1 "move" commands
+            if self.eol == "#" and len(line) >= 2:  # detect existing EOL to stay consistent when we'll be adding our own lines
+                if line[-2] == "\r":  # windows...
+                    self.eol = "\r\n"
+            self.line_count += 1
+        if self.eol == "#":
+            self.eol = "\n"  # uh oh empty file?
+
+    def __len__(self):
+        return len(self.line_numbers)
+
+    def move_heights(self):
+        for entry in xrange(len(self.line_numbers)):
+            if self.moves[entry]:
+                yield self.heights[entry]
+
+    def move_entries(self):
+        for entry in xrange(len(self.line_numbers)):
+            if self.moves[entry]:
+                yield self.line_numbers[entry], self.heights[entry]
+
+
+class ZHopDetector:
+    # Tells, for each move of a stream of (line number, Z), whether a lower Z follows within the `depth` lines
+    # starting at it, i.e. whether it goes up for a z-hop rather than to a new layer. The moves waiting for a
+    # decision stay in a bounded ring buffer, along with a monotonic queue of the candidates for the minimum Z
+    # of their window: any depth costs O(1) amortized per move, and works on streamed input.
+
+    def __init__(self, depth):
+        self.depth = depth
+        self.pending = deque()  # (line number, Z) of the moves still waiting for their decision
+        self.minima = deque()  # increasing Z of the pending moves that may still be the lowest of a window
+
+    def feed(self, number, z):
+        # Returns the (line number, Z, is z-hop) decisions this move makes possible, in stream order
+        decisions = []
+        while self.pending and number >= self.pending[0][0] + self.depth:
+            decisions.append(self.decide())
+        self.pending.append((number, z))
+        while self.minima and self.minima[-1][1] >= z:
+            self.minima.pop()
+        self.minima.append((number, z))
+        return decisions
+
+    def decide(self):
+        # All the moves following the oldest pending one are within its window
+        number, z = self.pending.popleft()
+        if self.minima[0][0] == number:
+            self.minima.popleft()
+        return number, z, bool(self.minima) and self.minima[0][1] < z
+
+    def scan(self, moves):
+        for number, z in moves:
+            for decision in self.feed(number, z):
+                yield decision
+        while self.pending:
+            yield self.decide()
 
 
 try:
@@ -143,17 +252,34 @@ try:
 except NameError:
     xrange = range
 
+try:
+    string_types = basestring  # python 2.7 vs 3 compatibility
+except NameError:
+    string_types = str
+
+try:
+    import queue
+except ImportError:
+    import Queue as queue  # python 2.7
+
+try:
+    import numpy as np
+except ImportError:
+    np = None  # Z profiles are then computed one Z at a time
+
+replace_file = getattr(os, "replace", os.rename)  # python 2.7 has no atomic replace, but rename is on posix
+
 
 class Perlin:
     # Perlin noise: http://mrl.nyu.edu/~perlin/noise/
 
-    def __init__(self, tile_dimension=256):
+    def __init__(self, tile_dimension=256, rng=random):
         self.tile_dimension = tile_dimension
         self.perm = [None] * 2 * tile_dimension
 
         permutation = []
         for value in xrange(tile_dimension): permutation.append(value)
-        random.shuffle(permutation)
+        rng.shuffle(permutation)
 
         for i in xrange(tile_dimension):
             self.perm[i] = permutation[i]
@@ -232,172 +358,964 @@ class Perlin:
             frequency *= 2
         return value / total_amplitude
 
+    # Batch versions of the above for whole arrays of coordinates (numpy). They chain the very same float
+    # operations in the same order, so that each value is bit for bit the one of the scalar version.
+
+    @staticmethod
+    def grad_batch(hash_code, x, y, z):
+        h = hash_code & 15
+        u = np.where(h < 8, x, y)
+        v = np.where(h < 4, y, np.where((h == 12) | (h == 14), x, z))
+        return np.where((h & 1) == 0, u, -u) + np.where((h & 2) == 0, v, -v)
+
+    def noise_batch(self, x, y, z):
+        perm = np.asarray(self.perm)
+        x, y, z = np.broadcast_arrays(np.asarray(x, dtype=float), np.asarray(y, dtype=float), np.asarray(z, dtype=float))
+        xi = np.trunc(x)
+        yi = np.trunc(y)
+        zi = np.trunc(z)
+        X = xi.astype(int) & (self.tile_dimension - 1)
+        Y = yi.astype(int) & (self.tile_dimension - 1)
+        Z = zi.astype(int) & (self.tile_dimension - 1)
+        x = x - xi
+        y = y - yi
+        z = z - zi
+        u = self.fade(x)
+        v = self.fade(y)
+        w = self.fade(z)
+        A = perm[X] + Y
+        AA = perm[A] + Z
+        AB = perm[A + 1] + Z
+        B = perm[X + 1] + Y
+        BA = perm[B] + Z
+        BB = perm[B + 1] + Z
+        grad = self.grad_batch
+        return self.lerp(w, self.lerp(v,
+            self.lerp(u, grad(perm[AA], x, y, z), grad(perm[BA], x - 1, y, z)),
+            self.lerp(u, grad(perm[AB], x, y - 1, z), grad(perm[BB], x - 1, y - 1, z))),
+            self.lerp(v,
+                self.lerp(u, grad(perm[AA + 1], x, y, z - 1), grad(perm[BA + 1], x - 1, y, z - 1)),
+                self.lerp(u, grad(perm[AB + 1], x, y - 1, z - 1), grad(perm[BB + 1], x - 1, y - 1, z - 1))))
+
+    def fractal_batch(self, octaves, persistence, x, y, z, frequency=1):
+        value = 0.0
+        amplitude = 1.0
+        total_amplitude = 0.0
+        for octave in xrange(octaves):
+            n = self.noise_batch(np.multiply(x, frequency), np.multiply(y, frequency), np.multiply(z, frequency))
+            value += amplitude * n
+            total_amplitude += amplitude
+            amplitude *= persistence
+            frequency *= 2
+        return value / total_amplitude
+
+
+class ProfileCache:
+    # Normalized Z profiles (the noise at each Z), kept in memory and on disk, keyed by a hash of the settings
+    # that shape them and of the Z set. Profiles only depend on these, so repeated runs skip the noise stage.
+    # The disk cache is trimmed to max_bytes, least recently used first.
+
+    VERSION = 1  # bump whenever the noise computation changes
+    MEMORY_ENTRIES = 16
+    memory = OrderedDict()  # shared by the whole process, and its threads
+    lock = threading.Lock()
+
+    def __init__(self, directory, max_bytes=32 * 1024 * 1024):
+        self.directory = directory
+        self.max_bytes = max_bytes
 
-with open(filename, "r") as f:
-    lines = f.readlines()
+    @classmethod
+    def key(cls, settings, zs):
+        return hashlib.sha1(repr((cls.VERSION, settings, zs)).encode("utf-8")).hexdigest()
+
+    def get(self, key, zs):
+        with self.lock:
+            values = self.memory.pop(key, None)
+        if values is None:
+            path = os.path.join(self.directory, key + ".json")
+            try:
+                with open(path, "r") as f:
+                    values = json.load(f)
+                os.utime(path, None)  # keep it recently used
+            except (IOError, OSError, ValueError):
+                return None
+            if len(values) != len(zs):
+                return None
+        self.remember(key, values)
+        return dict(zip(zs, values))
+
+    def remember(self, key, values):
+        # Most recently used last, the least recently used ones beyond MEMORY_ENTRIES are dropped
+        with self.lock:
+            self.memory[key] = values
+            while len(self.memory) > self.MEMORY_ENTRIES:
+                self.memory.popitem(last=False)
+
+    def put(self, key, zs, noises):
+        values = [noises[z] for z in zs]
+        self.remember(key, values)
+        try:
+            if not os.path.isdir(self.directory):
+                os.makedirs(self.directory)
+            fd, tmpname = tempfile.mkstemp(suffix=".tmp", dir=self.directory)
+            with os.fdopen(fd, "w") as f:
+                json.dump(values, f)  # floats are written with repr(), so they are read back exactly
+            replace_file(tmpname, os.path.join(self.directory, key + ".json"))
+            self.evict()
+        except (IOError, OSError):
+            pass  # a cache that cannot be written is not worth failing the print for
+
+    def evict(self):
+        entries = []
+        total = 0
+        for name in os.listdir(self.directory):
+            if name.endswith(".json"):
+                stat = os.stat(os.path.join(self.directory, name))
+                entries.append((stat.st_mtime, stat.st_size, name))
+                total += stat.st_size
+        entries.sort()
+        for mtime, size, name in entries:
+            if total <= self.max_bytes:
+                break
+            os.remove(os.path.join(self.directory, name))
+            total -= size
+
+
+wall_clock = getattr(time, "perf_counter", None) or time.time  # python 2.7 has neither perf_counter
+cpu_clock = getattr(time, "process_time", None) or time.clock  # nor process_time
+
+
+class Stopwatch:
+    # Wall and CPU time of the successive stages of a run, with the count of what each stage went through
+    # (lines, or Z values for the noise). Each start() ends the former stage, a stage run twice adds up.
+
+    def __init__(self):
+        self.stages = OrderedDict()  # name: [wall seconds, cpu seconds, count]
+        self.current = None
+
+    def start(self, name, count=0):
+        self.stop()
+        self.stages.setdefault(name, [0.0, 0.0, 0])[2] += count
+        self.current = (name, wall_clock(), cpu_clock())
+
+    def count(self, count):
+        self.stages[self.current[0]][2] += count
+
+    def stop(self):
+        if self.current is not None:
+            name, wall, cpu = self.current
+            stage = self.stages[name]
+            stage[0] += wall_clock() - wall
+            stage[1] += cpu_clock() - cpu
+            self.current = None
+
+    def add(self, stages):
+        for name, (wall, cpu, count) in stages.items():
+            stage = self.stages.setdefault(name, [0.0, 0.0, 0])
+            stage[0] += wall
+            stage[1] += cpu
+            stage[2] += count
+
+    def report(self, title):
+        lines = ["Profile of " + title + ":",
+                 "  %-10s %10s %10s %10s %12s" % ("stage", "wall s", "cpu s", "count", "count/s")]
+        totalWall = totalCpu = 0.0
+        for name, (wall, cpu, count) in self.stages.items():
+            rate = "%12.0f" % (count / wall) if count and wall > 0 else "%12s" % "-"
+            lines.append("  %-10s %10.4f %10.4f %10i %s" % (name, wall, cpu, count, rate))
+            totalWall += wall
+            totalCpu += cpu
+        lines.append("  %-10s %10.4f %10.4f" % ("total", totalWall, totalCpu))
+        return "\n".join(lines) + "\n"
 
 
 # Limit the number of changes for helicoidal/Joris slicing method
 minimumChangeZ = 0.1
 
-# Find the total height of the object (minus optional additional Z-hops)
-maxZ = 0
-thisZ = 0
-eol = "#"
-for line in lines:
-    thisZ = get_z(line)
-    if thisZ is not None:
-        if maxZ < thisZ:
-            maxZ = thisZ
-    if eol == "#" and len(line) >= 2:  # detect existing EOL to stay consistent when we'll be adding our own lines
-        if line[-2] == "\r":  # windows...
-            eol = "\r\n"
-if eol == "#":
-    eol = "\n"  # uh oh empty file?
-
-"First pass generates the noise curve. We will normalize it as the user expects to reach the min & max temperatures"
-perlin = Perlin()
-
-
-def perlin_to_normalized_wood(z):
-    banding = 3
-    octaves = 2
-    persistence = 0.7
-    noise = banding * perlin.fractal(octaves, persistence, 0, 0, (z + zOffset) / (grainSize * 2));
-    noise = (noise - math.floor(noise))  # normalized to [0,1]
-    noise = math.pow(noise, spikinessPower)
-    return noise
-
-
-# Generate normalized noises, and then temperatures (will be indexed by Z value)
-noises = {}
-# first value is hard encoded since some slicers do not write a Z0 at the first layer!
-noises[0] = perlin_to_normalized_wood(0)
-pendingNoise = None
-formerZ = -1
-for line in lines:
-    thisZ = get_z(line, formerZ)
-
-    if thisZ > 2 + formerZ:
-        formerZ = thisZ
-    # noises = {}  # some damn slicers include a big negative Z shift at the beginning, which impacts the min/max range
-    elif abs(thisZ - formerZ) > minimumChangeZ and thisZ > skipStartZ:
-        formerZ = thisZ
-        noises[thisZ] = perlin_to_normalized_wood(thisZ)
-
-# normalize built noises
-noisesMax = noises[max(noises, key=noises.get)]
-noisesMin = noises[min(noises, key=noises.get)]
-for z, v in noises.items():
-    noises[z] = (noises[z] - noisesMin) / (noisesMax - noisesMin)
-
-
-def noise_to_temp(noise):
-    return minTemp + noise * (maxTemp - minTemp)
-
-scanForZHop = int(scanForZHop)  # fix unicode error when using in range
-if scanForZHop > 5:
-    scanForZHop = 5
-
-
-def z_hop_scan_ahead(index, z):
-    if scanForZHop == 0:
-        return False  # Do not scan ahead
-    for i in range(scanForZHop):
-        checkZ = get_z(lines[index + i], z)
-        if checkZ < z:
-            return True  # Found z-hop
-    return False  # Did not find z-hop
 
+@contextmanager
+def replacing(filename, like=None):
+    # Write to a temporary file next to the original, then rename it over the original: a crash or an
+    # interruption half way never truncates the user's only copy. New files get the mode of `like`, if any,
+    # or the usual mode of new files (mkstemp creates them private).
+    fd, tmpname = tempfile.mkstemp(prefix=os.path.basename(filename) + ".", suffix=".tmp",
+                                   dir=os.path.dirname(os.path.abspath(filename)))
+    try:
+        with os.fdopen(fd, "w") as f:
+            yield f
+        if os.path.exists(like or filename):
+            shutil.copymode(like or filename, tmpname)
+        else:
+            umask = os.umask(0)  # the umask can only be read by setting it
+            os.umask(umask)
+            os.chmod(tmpname, 0o666 & ~umask)
+        replace_file(tmpname, filename)
+    except:
+        os.remove(tmpname)
+        raise
 
-#
-# Now save the file with the patched M104 temperature settings
-#
-with open(filename, "w") as f:
-    # Prepare a transposed ASCII-art temperature graph for the end of the file
-
-    f.write(";woodified gcode, see graph at the end - jeremie.francois@gmail.com - generated on " +
-            datetime.datetime.now().strftime("%Y%m%d-%H%M") + eol)
-    warmingTempCommands = "M230 S0" + eol  # enable wait for temp on the first change
-    t = firstTemp
-    if t == 0:
-        t = noise_to_temp(0)
-    warmingTempCommands += ("%s S%i" + eol) % (tempCommand, t)
-    # The two following commands depends on the firmware:
-    warmingTempCommands += "M230 S1" + eol  # now disable wait for temp on the first change
-    warmingTempCommands += "M116" + eol  # wait for the temperature to reach the setting (M109 is obsolete)
-    f.write(warmingTempCommands)
-
-    graphStr = ";WoodGraph: Wood temperature graph (from " + str(minTemp) + "C to " + str(
-        maxTemp) + "C, grain size " + str(grainSize) + "mm, z-offset " + str(zOffset) + ", scanForZHop " + str(scanForZHop) + ")"
-    if skipStartZ:
-        graphStr += ", skipped first " + str(skipStartZ) + "mm of print"
-    if maxUpward:
-        graphStr += ", temperature increases capped at " + str(maxUpward)
-    if maxDownward:
-        graphStr += ", temperature decreases capped at " + str(maxDownward)
-    graphStr += ":"
-    graphStr += eol
-
-    thisZ = -1
-    formerZ = -1
-    warned = 0
-
-    postponedTempDelta = 0  # only when maxUpward is used
-    postponedTempLast = None  # only when maxUpward is used
-    skip_lines = 0
-    for index, line in enumerate(lines):
-        if "; set extruder " in line.lower():  # special fix for BFB
-            f.write(line)
-            f.write(warmingTempCommands)
-            warmingTempCommands = ""
-        elif "; M104_M109" in line:
-            f.write(line)  # don't lose this remark!
-        elif skip_lines > 0:
-            skip_lines -= 1
-        elif ";woodified" in line.lower():
-            skip_lines = 4  # skip 4 more lines after our comment
-        elif not ";woodgraph" in line.lower():  # forget optional former temp graph lines in the file
-            if thisZ == maxZ:
-                f.write(line)  # no more patch, keep the important end scripts unchanged
-            elif not "m104" in line.lower():  # forget any previous temp in the file
-                thisZ = get_z(line, formerZ)
-                if thisZ != formerZ and thisZ in noises and not z_hop_scan_ahead(index, thisZ):
-
-                    if firstTemp != 0 and thisZ <= 0.5:  # if specified, keep the first temp for the first 0.5mm
-                        temp = firstTemp
-                    else:
-                        temp = noise_to_temp(noises[thisZ])
-
-                        # possibly cap temperature change upward
-                        temp += postponedTempDelta
-                        postponedTempDelta = 0
-                        if (postponedTempLast is not None)\
-                                and (maxUpward > 0)\
-                                and (temp > postponedTempLast + maxUpward ):
-                            postponedTempDelta = temp - (postponedTempLast + maxUpward)
-                            temp = postponedTempLast + maxUpward
-                        if (postponedTempLast is not None)\
-                                and (maxDownward > 0)\
-                                and (temp < postponedTempLast - maxDownward ):
-                            postponedTempDelta = postponedTempLast - maxDownward - temp
-                            temp = postponedTempLast - maxDownward
-                        if temp > maxTemp:
-                            postponedTempDelta = 0
-                            temp = maxTemp
-                        postponedTempLast = temp
-
-                        f.write(("%s S%i" + eol) % (tempCommand, temp))
-
-                    formerZ = thisZ
-
-                    # Build the corresponding graph line
-                    t = int(19 * (temp - minTemp) / (maxTemp - minTemp))
-                    graphStr += ";WoodGraph: Z %03f " % thisZ
-                    graphStr += "@%3iC | " % temp
-                    graphStr += '#'*t + '.'*(20 - t)
-                    graphStr += eol
-
-                f.write(line)
-
-    f.write(graphStr + eol)
+
+class ReadAhead:
+    # The lines of a file, read by a thread one chunk (a list of lines) at a time into a bounded queue, so that
+    # reading from a slow disk, a pipe or the network overlaps the processing of the former chunks. Iterate
+    # over its chunks, or over lines() for the lines themselves; close it (or use it with "with") when done.
+
+    CHUNK_BYTES = 1024 * 1024
+    DEPTH = 8  # chunks read ahead at most
+
+    def __init__(self, f):
+        self.f = f
+        self.queue = queue.Queue(self.DEPTH)
+        self.stopped = False
+        self.thread = threading.Thread(target=self.read)
+        self.thread.daemon = True
+        self.thread.start()
+
+    def read(self):
+        try:
+            while not self.stopped:
+                chunk = self.f.readlines(self.CHUNK_BYTES)
+                self.put(chunk)
+                if not chunk:
+                    return
+        except Exception as e:
+            self.put(e)
+
+    def put(self, item):
+        while not self.stopped:  # a consumer that gave up no longer drains the queue
+            try:
+                self.queue.put(item, timeout=0.1)
+                return
+            except queue.Full:
+                pass
+
+    def __iter__(self):
+        while True:
+            chunk = self.queue.get()
+            if isinstance(chunk, Exception):
+                raise chunk
+            if not chunk:
+                return
+            yield chunk
+
+    def keeping(self, keep):
+        # The chunks, also added to the keep list
+        for chunk in self:
+            keep.extend(chunk)
+            yield chunk
+
+    def lines(self, keep=None):
+        # The lines one by one, also added to the keep list if any
+        return itertools.chain.from_iterable(self if keep is None else self.keeping(keep))
+
+    def close(self):
+        self.stopped = True
+        self.thread.join()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exception):
+        self.close()
+
+
+class WriteBehind:
+    # Writes to a file from a thread, through a bounded queue of big chunks, so that writing to a slow disk, a
+    # pipe or the network overlaps the processing of what comes next. write() only buffers, as cheaply as
+    # list.append, until handoff() queues the buffer: writelines() and the lines of paced() hand it off every
+    # CHUNK_LINES lines. close() (or the end of a "with") waits for the writes and raises their error, if any.
+
+    CHUNK_LINES = 16384
+    DEPTH = 8  # chunks waiting to be written at most
+
+    def __init__(self, f):
+        self.f = f
+        self.buffer = []
+        self.write = self.buffer.append
+        self.queue = queue.Queue(self.DEPTH)
+        self.error = None
+        self.thread = threading.Thread(target=self.drain)
+        self.thread.daemon = True
+        self.thread.start()
+
+    def drain(self):
+        while True:
+            chunk = self.queue.get()
+            if chunk is None:
+                return
+            if self.error is None:  # after an error, the chunks are only drained
+                try:
+                    self.f.write(chunk)
+                except Exception as e:
+                    self.error = e
+
+    def handoff(self):
+        if self.error is not None:
+            raise self.error
+        if self.buffer:
+            self.queue.put("".join(self.buffer))
+            del self.buffer[:]  # the same list, which write() appends to
+
+    def blocks(self, lines):
+        # The lines in lists of CHUNK_LINES, what was written meanwhile being handed off after each of them
+        lines = iter(lines)
+        while True:
+            block = list(itertools.islice(lines, self.CHUNK_LINES))
+            if not block:
+                return
+            yield block
+            self.handoff()
+
+    def paced(self, lines):
+        # The lines one by one, for a loop that write()s as it goes
+        return itertools.chain.from_iterable(self.blocks(lines))
+
+    def writelines(self, lines):
+        for block in self.blocks(lines):
+            self.buffer.extend(block)
+
+    def close(self):
+        try:
+            self.handoff()
+        finally:
+            self.queue.put(None)
+            self.thread.join()
+        if self.error is not None:
+            raise self.error
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exception):
+        self.close()
+
+
+class WoodGcode:
+    # A gcode input, tokenized once: its Z index, its height and the Z values that will need a temperature.
+    # The source is a path (a string naming an existing file), a string of gcode (any other string, even empty or
+    # a single line) or an iterable of lines with their line endings, e.g. an open file. Its lines are held in memory, unless it is a path loaded with
+    # stream=True: the file is then read again each time it is woodified, and only its Z index is held.
+    # With pipeline=True, files are read by a ReadAhead thread while the lines already read are tokenized.
+
+    def __init__(self, source, skipStartZ=0, stream=False, stopwatch=None, pipeline=False):
+        stopwatch = stopwatch or Stopwatch()
+        self.path = None
+        self.lines = None
+        self.pipeline = pipeline
+        if isinstance(source, string_types) and os.path.exists(source):
+            self.path = source
+            if stream:
+                stopwatch.start("zscan")
+                with self.reading() as lines:
+                    self.index = ZIndex(lines)
+            elif pipeline:
+                stopwatch.start("zscan")  # reading included, it overlaps
+                lines = []
+                with open(source, "r") as f:
+                    with ReadAhead(f) as chunks:
+                        self.index = ZIndex(chunks.lines(keep=lines))
+                self.lines = lines
+            else:
+                stopwatch.start("read")
+                with open(source, "r") as f:
+                    self.lines = f.readlines()
+        else:
+            stopwatch.start("read")
+            self.lines = source.splitlines(True) if isinstance(source, string_types) else list(source)
+        if not hasattr(self, "index"):
+            stopwatch.count(len(self.lines))
+            stopwatch.start("zscan")
+            self.index = ZIndex(self.lines)
+        stopwatch.count(self.index.line_count)
+        self.eol = self.index.eol
+        self.maxZ, self.zs = self.scan_heights(skipStartZ)
+        stopwatch.stop()
+
+    def scan_heights(self, skipStartZ):
+        # Find the total height of the object (minus optional additional Z-hops) and the Z values that will need
+        # a temperature
+        maxZ = 0
+        # first value is hard encoded since some slicers do not write a Z0 at the first layer!
+        zs = [0]
+        formerZ = -1
+        for thisZ in self.index.move_heights():
+            if maxZ < thisZ:
+                maxZ = thisZ
+            if thisZ > 2 + formerZ:
+                formerZ = thisZ
+            # noises = {}  # some damn slicers include a big negative Z shift at the beginning, which impacts the min/max range
+            elif abs(thisZ - formerZ) > minimumChangeZ and thisZ > skipStartZ:
+                formerZ = thisZ
+                zs.append(thisZ)
+        return maxZ, zs
+
+    @contextmanager
+    def reading(self):
+        # The lines, from memory or read again from the file
+        if self.lines is not None:
+            yield self.lines
+        elif self.pipeline:
+            with open(self.path, "r") as f:
+                with ReadAhead(f) as chunks:
+                    yield chunks.lines()
+        else:
+            with open(self.path, "r") as f:
+                yield f
+
+
+class WoodSlots:
+    # Where the temperature commands of a woodified file are: their byte offsets (they are padded to a fixed
+    # width), and what it takes to compute them again. Kept next to the file as a sidecar (file.wood.json),
+    # it lets a later run with other settings patch these commands in place, rather than rewrite the file.
+
+    VERSION = 1
+    DIGITS = 4  # up to 9999C
+
+    def __init__(self, settings, zs, eol, tell=None):
+        self.settings = settings  # what the offsets depend on, see WoodProcessor.slot_settings()
+        self.zs = zs  # the Z set the noise is normalized over
+        self.eol = eol
+        self.width = len(settings["tempCommand"]) + 2 + self.DIGITS
+        self.tell = tell  # the offset the output has reached, while it is written
+        self.header = None  # offset of the ;woodified line
+        self.warming = []  # offsets of the temperature command of the warming commands
+        self.entries = []  # (Z, offset of its temperature command, or None for firstTemp) of each graph line
+        self.footer = None  # offset of the graph
+        self.size = None
+
+    @staticmethod
+    def sidecar(path):
+        return path + ".wood.json"
+
+    def save(self, path):
+        self.size = os.path.getsize(path)
+        fields = dict((name, getattr(self, name)) for name in
+                      ("settings", "zs", "eol", "width", "header", "warming", "entries", "footer", "size"))
+        fields["version"] = self.VERSION
+        fd, tmpname = tempfile.mkstemp(suffix=".tmp", dir=os.path.dirname(os.path.abspath(path)))
+        with os.fdopen(fd, "w") as f:
+            json.dump(fields, f)
+        shutil.copymode(path, tmpname)
+        replace_file(tmpname, self.sidecar(path))
+
+    @classmethod
+    def load(cls, path):
+        try:
+            with open(cls.sidecar(path), "r") as f:
+                fields = json.load(f)
+        except (IOError, OSError, ValueError):
+            return None
+        if fields.get("version") != cls.VERSION:
+            return None
+        slots = cls(fields["settings"], fields["zs"], fields["eol"])
+        slots.header = fields["header"]
+        slots.warming = fields["warming"]
+        slots.entries = [tuple(entry) for entry in fields["entries"]]
+        slots.footer = fields["footer"]
+        slots.size = fields["size"]
+        return slots if slots.width == fields["width"] else None
+
+
+class WoodProcessor:
+    # The wood engine. It holds its settings, its own random generator and Perlin table, and the stopwatch of
+    # what it did, and shares nothing with other instances: several of them can run in the threads of a
+    # process, and one can woodify any number of inputs in turn, e.g.
+    #
+    #   processor = WoodProcessor(minTemp=180, maxTemp=230, randomSeed=42)
+    #   woodified = processor.process(gcodeString)  # or a path, or lines
+    #   processor.woodify("print.gcode")  # in place, or into a target
+    #   for line in processor.lines(open("print.gcode")): ...  # streamed
+    #   processor.woodify("print.gcode", sidecar=True)  # then, with other settings, processor.patch("print.gcode")
+    #
+    # Unseeded processors get a random, but fixed, Perlin table. Their profiles are not cached.
+
+    def __init__(self, minTemp=190, maxTemp=240, firstTemp=0, grainSize=3, maxUpward=0, maxDownward=0, skipStartZ=0,
+                 zOffset=0, scanForZHop=5, spikinessPower=1.0, tempCommand='M104', randomSeed=None,
+                 cacheDir=DEFAULT_CACHE_DIR, keepRedundant=False):
+        self.minTemp = minTemp
+        self.maxTemp = maxTemp
+        self.firstTemp = firstTemp
+        self.grainSize = grainSize
+        self.maxUpward = maxUpward
+        self.maxDownward = maxDownward
+        self.skipStartZ = skipStartZ
+        self.zOffset = zOffset
+        self.scanForZHop = int(scanForZHop)  # fix unicode error when using in range
+        self.spikinessPower = spikinessPower
+        self.tempCommand = tempCommand
+        self.randomSeed = randomSeed
+        self.cacheDir = cacheDir
+        self.keepRedundant = keepRedundant  # else drop the temperature commands that would not change the setting
+        self.droppedTemps = 0  # by the last emission
+        self.random = random.Random(randomSeed)
+        self.perlin = None  # built on the first profile that is not in the cache
+        self.stopwatch = Stopwatch()
+
+    def load(self, source, stream=False, pipeline=False):
+        if isinstance(source, WoodGcode):
+            return source
+        return WoodGcode(source, self.skipStartZ, stream, self.stopwatch, pipeline)
+
+    # First pass generates the noise curve. We will normalize it as the user expects to reach the min & max temperatures
+
+    def perlin_to_normalized_wood(self, z):
+        banding = 3
+        octaves = 2
+        persistence = 0.7
+        noise = banding * self.perlin.fractal(octaves, persistence, 0, 0, (z + self.zOffset) / (self.grainSize * 2));
+        noise = (noise - math.floor(noise))  # normalized to [0,1]
+        noise = math.pow(noise, self.spikinessPower)
+        return noise
+
+    def perlin_to_normalized_woods(self, zs):
+        # Same as perlin_to_normalized_wood() for a whole list of Z, in one vectorized call when numpy is there
+        if np is None:
+            return [self.perlin_to_normalized_wood(z) for z in zs]
+        banding = 3
+        octaves = 2
+        persistence = 0.7
+        noise = banding * self.perlin.fractal_batch(octaves, persistence, 0, 0,
+                                                    (np.asarray(zs, dtype=float) + self.zOffset) / (self.grainSize * 2))
+        noise = (noise - np.floor(noise))  # normalized to [0,1]
+        return [math.pow(n, self.spikinessPower) for n in noise.tolist()]  # math.pow rounds exactly like the scalar path
+
+    def woodgrain_profile(self, zs):
+        # Normalized noise at each Z with the current settings, straight from the cache when it has them
+        self.stopwatch.start("noise", len(zs))
+        noises = None
+        profileCache = None
+        if self.cacheDir and self.randomSeed is not None:  # unseeded profiles are random, there is nothing to reuse
+            profileCache = ProfileCache(self.cacheDir)
+            profileKey = ProfileCache.key(("wood", self.randomSeed, self.grainSize, self.spikinessPower, self.zOffset), zs)
+            noises = profileCache.get(profileKey, zs)
+
+        if noises is None:
+            if self.perlin is None:
+                self.perlin = Perlin(rng=self.random)
+            noises = dict(zip(zs, self.perlin_to_normalized_woods(zs)))
+
+            # normalize built noises
+            noisesMax = noises[max(noises, key=noises.get)]
+            noisesMin = noises[min(noises, key=noises.get)]
+            for z, v in noises.items():  # a flat profile (e.g. a single Z) stays at the minimum temperature
+                noises[z] = (noises[z] - noisesMin) / (noisesMax - noisesMin) if noisesMax > noisesMin else 0.0
+
+            if profileCache is not None:
+                profileCache.put(profileKey, zs, noises)
+        self.stopwatch.stop()
+        return noises
+
+    def noise_to_temp(self, noise):
+        return self.minTemp + noise * (self.maxTemp - self.minTemp)
+
+    def header_line(self, eol):
+        return (";woodified gcode, see graph at the end - jeremie.francois@gmail.com - generated on " +
+                datetime.datetime.now().strftime("%Y%m%d-%H%M") + eol)
+
+    def temp_command(self, temp, eol, slots=None):
+        command = "%s S%i" % (self.tempCommand, temp)
+        if slots is not None:
+            command = command.ljust(slots.width)  # a fixed width slot, that another temperature can replace
+        return command + eol
+
+    def slot_temperature(self, z, noises, postponed):
+        # The temperature at the Z change to z, from its noise. The maxUpward/maxDownward caps may postpone
+        # part of a change to the next ones: postponed holds the [delta, last temperature] they carry over.
+        postponedTempDelta, postponedTempLast = postponed
+        maxUpward = self.maxUpward
+        maxDownward = self.maxDownward
+        temp = self.noise_to_temp(noises[z])
+
+        # possibly cap temperature change upward
+        temp += postponedTempDelta
+        postponedTempDelta = 0
+        if (postponedTempLast is not None)\
+                and (maxUpward > 0)\
+                and (temp > postponedTempLast + maxUpward ):
+            postponedTempDelta = temp - (postponedTempLast + maxUpward)
+            temp = postponedTempLast + maxUpward
+        if (postponedTempLast is not None)\
+                and (maxDownward > 0)\
+                and (temp < postponedTempLast - maxDownward ):
+            postponedTempDelta = postponedTempLast - maxDownward - temp
+            temp = postponedTempLast - maxDownward
+        if temp > self.maxTemp:
+            postponedTempDelta = 0
+            temp = self.maxTemp
+        postponed[:] = [postponedTempDelta, temp]
+        return temp
+
+    def graph_header(self, eol):
+        graphStr = ";WoodGraph: Wood temperature graph (from " + str(self.minTemp) + "C to " + str(
+            self.maxTemp) + "C, grain size " + str(self.grainSize) + "mm, z-offset " + str(self.zOffset) + ", scanForZHop " + str(self.scanForZHop) + ")"
+        if self.skipStartZ:
+            graphStr += ", skipped first " + str(self.skipStartZ) + "mm of print"
+        if self.maxUpward:
+            graphStr += ", temperature increases capped at " + str(self.maxUpward)
+        if self.maxDownward:
+            graphStr += ", temperature decreases capped at " + str(self.maxDownward)
+        graphStr += ":"
+        graphStr += eol
+        return graphStr
+
+    def graph_line(self, z, temp, eol):
+        # Build the corresponding graph line
+        t = int(19 * (temp - self.minTemp) / (self.maxTemp - self.minTemp))
+        return ";WoodGraph: Z %03f " % z + "@%3iC | " % temp + '#'*t + '.'*(20 - t) + eol
+
+    def emit(self, gcode, lines, noises, slots=None):
+        # Generates the woodified gcode from the lines of gcode, with the patched M104 temperature settings
+        # and a transposed ASCII-art temperature graph at the end. With slots (a WoodSlots), the temperature
+        # commands have a fixed width, and their offsets are recorded as they are reached. Otherwise the commands
+        # that would set the very (integer) temperature already set are dropped, and counted in droppedTemps.
+        eol = gcode.eol
+        maxZ = gcode.maxZ
+        firstTemp = self.firstTemp
+
+        if slots is not None:
+            slots.header = slots.tell()
+        yield self.header_line(eol)
+        t = firstTemp
+        if t == 0:
+            t = self.noise_to_temp(0)
+        warmingTempCommands = ["M230 S0" + eol,  # enable wait for temp on the first change
+                               self.temp_command(t, eol, slots),
+                               # The two following commands depends on the firmware:
+                               "M230 S1" + eol,  # now disable wait for temp on the first change
+                               "M116" + eol]  # wait for the temperature to reach the setting (M109 is obsolete)
+        for command in warmingTempCommands:
+            if slots is not None and command is warmingTempCommands[1]:
+                slots.warming.append(slots.tell())
+            yield command
+        dropRedundant = slots is None and not self.keepRedundant  # slots must all be there to be patched
+        self.droppedTemps = 0
+        sentTemp = int(t)  # as "%i" truncates it
+
+        graphStr = self.graph_header(eol)
+
+        thisZ = -1
+        formerZ = -1
+        warned = 0
+
+        postponed = [0, None]  # only when maxUpward or maxDownward are used
+        skip_lines = 0
+        zHops = ZHopDetector(self.scanForZHop).scan(gcode.index.move_entries())
+        nextMove = next(zHops, None)
+        line = eol  # then the last line of the source
+        for number, line in enumerate(lines):
+            lineZ = None
+            if nextMove is not None and nextMove[0] == number:
+                number, lineZ, lineIsZHop = nextMove
+                nextMove = next(zHops, None)
+
+            if "; set extruder " in line.lower():  # special fix for BFB
+                yield line
+                for command in warmingTempCommands:
+                    if slots is not None and command is warmingTempCommands[1]:
+                        slots.warming.append(slots.tell())
+                    yield command
+                if warmingTempCommands:
+                    sentTemp = int(t)
+                warmingTempCommands = []
+            elif "; M104_M109" in line:
+                yield line  # don't lose this remark!
+            elif skip_lines > 0:
+                skip_lines -= 1
+            elif ";woodified" in line.lower():
+                skip_lines = 4  # skip 4 more lines after our comment
+            elif not ";woodgraph" in line.lower():  # forget optional former temp graph lines in the file
+                if thisZ == maxZ:
+                    yield line  # no more patch, keep the important end scripts unchanged
+                elif not "m104" in line.lower():  # forget any previous temp in the file
+                    thisZ = formerZ if lineZ is None else lineZ
+                    if thisZ != formerZ and thisZ in noises and not lineIsZHop:
+
+                        if firstTemp != 0 and thisZ <= 0.5:  # if specified, keep the first temp for the first 0.5mm
+                            temp = firstTemp
+                            if slots is not None:
+                                slots.entries.append((thisZ, None))
+                        else:
+                            temp = self.slot_temperature(thisZ, noises, postponed)
+                            if dropRedundant and int(temp) == sentTemp:
+                                self.droppedTemps += 1
+                            else:
+                                if slots is not None:
+                                    slots.entries.append((thisZ, slots.tell()))
+                                yield self.temp_command(temp, eol, slots)
+                                sentTemp = int(temp)
+
+                        formerZ = thisZ
+                        graphStr += self.graph_line(thisZ, temp, eol)
+
+                    yield line
+                    if "m109" in line.lower():  # a temperature set by the file itself, the next one is not redundant
+                        sentTemp = None
+
+        if not line.endswith("\n"):
+            yield eol  # the source has no final line break, the graph starts on a line of its own
+        self.stopwatch.start("footer", graphStr.count(eol) + 1)
+        if slots is not None:
+            slots.footer = slots.tell()
+        yield graphStr + eol
+
+    def lines(self, source):
+        # Streams the woodified gcode of source (anything load() takes), one line or so at a time
+        gcode = self.load(source)
+        noises = self.woodgrain_profile(gcode.zs)
+        with gcode.reading() as lines:
+            self.stopwatch.start("emission", gcode.index.line_count)
+            for chunk in self.emit(gcode, lines, noises):
+                yield chunk
+        self.stopwatch.stop()
+
+    def process(self, source):
+        # The woodified gcode of source (anything load() takes), as a string
+        return "".join(self.lines(source))
+
+    def woodify(self, source, target=None, stream=False, sidecar=False, pipeline=False):
+        # Save the woodified gcode of source into target, in place by default (when source is a path). With
+        # sidecar, its temperature commands get fixed width slots, listed in a sidecar for patch() to reuse.
+        # With pipeline, the file is read and written by threads (see ReadAhead and WriteBehind) while the
+        # lines are processed.
+        gcode = self.load(source, stream, pipeline)
+        target = target or gcode.path
+        if target is None:
+            raise ValueError("woodify() needs a target file for gcode that was not read from a file")
+        noises = self.woodgrain_profile(gcode.zs)
+        slots = None
+        with replacing(target, like=gcode.path) as f:
+            with gcode.reading() as lines:
+                self.stopwatch.start("emission", gcode.index.line_count)
+                if sidecar:
+                    slots = WoodSlots(self.slot_settings(), gcode.zs, gcode.eol, f.tell)
+                    for chunk in self.emit(gcode, lines, noises, slots):  # one at a time, for f.tell()
+                        f.write(chunk)
+                elif pipeline:
+                    with WriteBehind(f) as writer:
+                        writer.writelines(self.emit(gcode, lines, noises))
+                else:
+                    f.writelines(self.emit(gcode, lines, noises))
+            self.stopwatch.start("write")
+        if slots is not None:
+            slots.save(target)
+        elif os.path.exists(WoodSlots.sidecar(target)):
+            os.remove(WoodSlots.sidecar(target))  # its offsets are stale now
+        self.stopwatch.stop()
+        return target
+
+    def slot_settings(self):
+        # What decides where the temperature commands go, and how wide they are
+        return {"skipStartZ": self.skipStartZ, "scanForZHop": self.scanForZHop, "tempCommand": self.tempCommand,
+                "firstTemp": self.firstTemp != 0}
+
+    def patch(self, path):
+        # Woodify path again with the current settings through its sidecar: only the temperature commands,
+        # the header date and the footer are written, in place. Returns False, and leaves the file alone,
+        # when it has no sidecar, or one that does not match the file or the settings.
+        slots = WoodSlots.load(path)
+        if slots is None or slots.settings != self.slot_settings():
+            return False
+        noises = self.woodgrain_profile(slots.zs)
+        self.stopwatch.start("patch", len(slots.entries))
+        eol = slots.eol
+        commands = [(slots.header, self.header_line("").encode("utf-8"))]
+        t = self.firstTemp
+        if t == 0:
+            t = self.noise_to_temp(0)
+        commands += [(offset, self.temp_command(t, "", slots).encode("utf-8")) for offset in slots.warming]
+        graphStr = self.graph_header(eol)
+        postponed = [0, None]
+        for z, offset in slots.entries:
+            if offset is None:
+                temp = self.firstTemp
+            else:
+                temp = self.slot_temperature(z, noises, postponed)
+                commands.append((offset, self.temp_command(temp, "", slots).encode("utf-8")))
+            graphStr += self.graph_line(z, temp, eol)
+        footer = (graphStr + eol).replace("\n", os.linesep).encode("utf-8")  # like text mode writes it
+
+        with open(path, "r+b") as f:
+            if os.fstat(f.fileno()).st_size != slots.size:
+                return False
+            data = mmap.mmap(f.fileno(), 0)
+            try:
+                # Every slot must still be where the sidecar says, and every temperature must fit
+                end = slots.header + len(commands[0][1])  # the new header must be just as long
+                if not data[slots.header:end].startswith(b";woodified") or data[end:end + 1] not in (b"\r", b"\n"):
+                    return False
+                prefix = (self.tempCommand + " S").encode("utf-8")
+                for offset, command in commands[1:]:
+                    if len(command) != slots.width or data[offset:offset + len(prefix)] != prefix:
+                        return False
+                if data[slots.footer:slots.footer + 11] != b";WoodGraph:":
+                    return False
+                os.remove(WoodSlots.sidecar(path))  # out of sync with the file until the end
+                for offset, command in commands:
+                    data[offset:offset + len(command)] = command
+                data.flush()
+            finally:
+                data.close()
+            self.stopwatch.start("footer", graphStr.count(eol) + 1)
+            f.seek(slots.footer)
+            f.write(footer)
+            f.truncate()
+        slots.save(path)
+        self.stopwatch.stop()
+        return True
+
+
+# Command line (and Cura plugin) entry points, a thin wrapper around WoodProcessor
+
+sweepInput = None  # the WoodGcode of a sweep, inherited by forked workers
+
+
+def sweep_target(filename, seed, grain, spikiness):
+    root, extension = os.path.splitext(filename)
+    seedName = "" if seed is None else ".seed%s" % seed
+    return "%s%s.grain%g.spikiness%g%s" % (root, seedName, grain, spikiness, extension)
+
+
+def woodify_variant(variant):
+    # One combination of a sweep, in a worker that already holds the parsed file
+    settings, target, sidecar = variant
+    processor = WoodProcessor(**settings)
+    processor.woodify(sweepInput, target, sidecar=sidecar)
+    return target, processor.stopwatch.stages, processor.droppedTemps  # the stages go back with the result
+
+
+def main(argv):
+    global sweepInput
+    opts, extraparams = getopt.getopt(argv, 'i:a:t:g:u:d:r:s:z:k:c:f:w:h',
+                                      ['min=', 'max=', 'first-temp=', 'grain=', 'max-upward=', 'max-downward=', 'random-seed=',
+                                       'spikiness-power=', 'z-offset=', 'skip-start-z=', 'scan-for-z-hop=', 'temp-command', 'file=', 'stream', 'cache-dir=', 'no-cache',
+                                       'sweep-seeds=', 'sweep-grains=', 'sweep-spikiness=', 'jobs=', 'batch=',
+                                       'keep-redundant', 'sidecar', 'pipeline', 'profile', 'profile-dump=', 'help'])
+    settings = {}  # WoodProcessor settings, its defaults for the others
+    filename = ""
+    streamInput = False  # read the file twice rather than holding it in memory
+    sweepSeeds = []  # sweep mode, when any of these lists is given
+    sweepGrains = []
+    sweepSpikiness = []
+    jobs = multiprocessing.cpu_count()
+    batchSource = None  # batch mode, in place of a single file
+    profileRun = False  # print the time of each stage at the end
+    profileDump = None  # where to save a cProfile of the run, if anywhere
+    sidecar = False  # fixed width temperature commands, listed next to the file for later runs to patch
+    pipeline = False  # read and write in threads, while processing
+    for o, p in opts:
+        if o in ['-f', '--file']:
+            filename = p
+        elif o in ['-i', '--min']:
+            settings["minTemp"] = float(p)
+        elif o in ['-a', '--max']:
+            settings["maxTemp"] = float(p)
+        elif o in ['-t', '--first-temp']:
+            settings["firstTemp"] = float(p)
+        elif o in ['-g', '--grain']:
+            settings["grainSize"] = float(p)
+        elif o in ['-u', '--max-upward']:
+            settings["maxUpward"] = float(p)
+        elif o in ['-d', '--max-downward']:
+            settings["maxDownward"] = float(p)
+        elif o in ['-k', '--skip-start-z']:
+            settings["skipStartZ"] = float(p)
+        elif o in ['-z', '--z-offset']:
+            settings["randomSeed"] = 0
+            settings["zOffset"] = float(p)
+        elif o in ['-c', '--scan-for-z-hop']:
+            settings["scanForZHop"] = int(p)
+        elif o in ['-r', '--random-seed']:
+            if p != 0:
+                settings["randomSeed"] = p
+        elif o in ['-s', '--spikiness-power']:
+            settings["spikinessPower"] = float(p)
+            if settings["spikinessPower"] <= 0:
+                settings["spikinessPower"] = 1.0
+        elif o in ['-w', '--temp-command']:
+            settings["tempCommand"] = p  # e.g. M109 in place of default M104, see https://www.simplify3d.com/support/articles/3d-printing-gcode-tutorial/#M104-M109
+        elif o == '--stream':
+            streamInput = True
+        elif o == '--cache-dir':
+            settings["cacheDir"] = p
+        elif o == '--no-cache':
+            settings["cacheDir"] = None
+        elif o == '--sweep-seeds':
+            sweepSeeds = p.split(',')  # kept as strings, just like --random-seed
+        elif o == '--sweep-grains':
+            sweepGrains = [float(v) for v in p.split(',')]
+        elif o == '--sweep-spikiness':
+            sweepSpikiness = [float(v) if float(v) > 0 else 1.0 for v in p.split(',')]
+        elif o == '--jobs':
+            jobs = int(p)
+        elif o == '--batch':
+            batchSource = p
+        elif o == '--sidecar':
+            sidecar = True
+        elif o == '--keep-redundant':
+            settings["keepRedundant"] = True
+        elif o == '--pipeline':
+            pipeline = True
+        elif o == '--profile':
+            profileRun = True
+        elif o == '--profile-dump':
+            profileRun = True
+            profileDump = p
+    if batchSource:
+        batchArguments = ['--jobs', '1']  # batch workers are busy enough, and cannot fork sweep workers anyway
+        for o, p in opts:
+            if o not in ['-f', '--file', '--batch', '--jobs']:
+                batchArguments += [o, p] if p else [o]
+        return run_batch(batchSource, batchArguments, jobs)
+    if not filename:
+        plugin_standalone_usage(inspect.stack()[0][1])
+    if not os.path.exists(filename):  # else it would be taken for gcode
+        sys.stderr.write("no such file: %s\n" % filename)
+        return 2
+
+    profiler = None
+    if profileDump:
+        profiler = cProfile.Profile()
+        profiler.enable()
+    processor = WoodProcessor(**settings)
+    if sweepSeeds or sweepGrains or sweepSpikiness:
+        gcode = processor.load(filename, streamInput, pipeline)
+        variants = []
+        for seed in sweepSeeds or [processor.randomSeed]:
+            for grain in sweepGrains or [processor.grainSize]:
+                for spikiness in sweepSpikiness or [processor.spikinessPower]:
+                    variant = dict(settings, randomSeed=seed, grainSize=grain, spikinessPower=spikiness)
+                    variants.append((variant, sweep_target(filename, seed, grain, spikiness), sidecar))
+        sweepInput = gcode
+        pool = worker_pool(min(jobs, len(variants)))
+        if pool is None:
+            written = map(woodify_variant, variants)
+        else:
+            written = pool.imap(woodify_variant, variants)
+        for target, stages, droppedTemps in written:
+            processor.stopwatch.add(stages)
+            print(target)
+            if droppedTemps:
+                sys.stderr.write("%s: %i redundant temperature commands dropped\n" % (target, droppedTemps))
+        if pool is not None:
+            pool.close()
+            pool.join()
+        sweepInput = None
+    elif not (sidecar and processor.patch(filename)):  # a patched file is not even read
+        processor.woodify(filename, stream=streamInput, sidecar=sidecar, pipeline=pipeline)
+        if processor.droppedTemps:
+            sys.stderr.write("%i redundant temperature commands dropped\n" % processor.droppedTemps)
+
+    if profiler is not None:
+        profiler.disable()
+        profiler.dump_stats(profileDump)
+    if profileRun:
+        sys.stderr.write(processor.stopwatch.report(filename))
+
+
+if "filename" in globals():
+    # Cura runs this file as a plugin, with the #Param: settings above and the gcode filename as globals
+    WoodProcessor(minTemp=minTemp, maxTemp=maxTemp, firstTemp=firstTemp, grainSize=grainSize, maxUpward=maxUpward,
+                  maxDownward=maxDownward, skipStartZ=skipStartZ, zOffset=zOffset, scanForZHop=scanForZHop,
+                  spikinessPower=spikinessPower, tempCommand=tempCommand).woodify(filename)
+elif __name__ == "__main__":
+    sys.exit(main(sys.argv[1:]))